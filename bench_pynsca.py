@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+
+# The contents of this file are subject to the Mozilla Public License
+# Version 1.1 (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS"
+# basis, WITHOUT WARRANTY OF ANY KIND, either express or implied. See the
+# License for the specific language governing rights and limitations
+# under the License.
+#
+# The Original Code is pynsca.
+#
+# The Initial Developer of the Original Code is Dustin J. Mitchell.  Portions
+# created by Dustin J. Mitchell are Copyright (C) Mozilla, Inc. All Rights
+# Reserved.
+#
+# Alternatively, the contents of this file may be used under the terms of the
+# GNU Public License, Version 2 (the  "GPLv2 License"), in which case the
+# provisions of GPLv2 License are applicable instead of those above. If you
+# wish to allow use of your version of this file only under the terms of the
+# GPLv2 License and not to allow others to use your version of this file under
+# the MPL, indicate your decision by deleting the provisions above and replace
+# them with the notice and other provisions required by the GPLv2 License. If
+# you do not delete the provisions above, a recipient may use your version of
+# this file under either the MPL or the GPLv2 License.
+
+"""
+Benchmarks for pynsca.
+
+Measures packet encoding, each encryption mode (with and without a
+password) across output sizes, and end-to-end sends to a loopback
+NSCAReceiver with 1, 10 and 100 concurrent senders.  Results are printed
+as a table; use --json to also write them in machine-readable form, for
+comparison across versions.  Latencies are per call: for send_batch, each
+call sends batch_size packets over one connection.
+
+    python bench_pynsca.py [--duration SECONDS] [--json FILE]
+"""
+
+import sys
+import json
+import platform
+import argparse
+import threading
+import timeit
+
+import pynsca
+
+OUTPUT_SIZES = [0, 64, 256, 512]
+SENDERS = [1, 10, 100]
+
+# (encryption_mode, password); modes needing PyCrypto are skipped without it
+MODES = [
+    (0, None),
+    (1, None),
+    (1, 'secret'),
+    (2, 'secret'),
+    (3, 'abcdefghijklmnopqrstuvwx'),
+    (4, 'secret'),
+    (8, 'secret'),
+    (16, 'secret'),
+]
+
+clock = timeit.default_timer
+
+
+def percentile(sorted_times, pct):
+    return sorted_times[min(len(sorted_times) - 1,
+                            int(len(sorted_times) * pct / 100.0))]
+
+
+def summarize(name, params, times, elapsed, packets=None):
+    """
+    Summarize per-operation latencies (in seconds) as a result dictionary,
+    with latencies in microseconds.
+    """
+    times = sorted(times)
+    if packets is None:
+        packets = len(times)
+    result = dict(name=name, packets=packets,
+                  packets_per_sec=packets / elapsed)
+    result.update(params)
+    for pct in (50, 90, 99):
+        result['p%d_us' % pct] = percentile(times, pct) * 1e6
+    result['max_us'] = times[-1] * 1e6
+    return result
+
+
+def run_timed(fn, duration, min_runs=10):
+    """
+    Call C{fn} repeatedly for about C{duration} seconds, returning the
+    latency of each call and the total elapsed time.
+    """
+    times = []
+    start = clock()
+    while 1:
+        t = clock()
+        fn()
+        now = clock()
+        times.append(now - t)
+        if now - start >= duration and len(times) >= min_runs:
+            return times, now - start
+
+
+def bench_encode(duration):
+    notif = pynsca.NSCANotifier('localhost')
+    for size in OUTPUT_SIZES:
+        output = 'x' * size
+        times, elapsed = run_timed(
+            lambda: notif._pack_to_server(1304029911, pynsca.OK,
+                                          'host.example.com', 'service',
+                                          output),
+            duration)
+        yield summarize('encode', dict(output_size=size), times, elapsed)
+
+
+def bench_encrypt(duration):
+    iv = b'\x5a' * 128
+    for mode, password in MODES:
+        notif = pynsca.NSCANotifier('localhost', encryption_mode=mode,
+                                    password=password)
+        try:
+            encrypt = notif._encryptor(iv, mode, password)
+        except ImportError:
+            continue
+        for size in OUTPUT_SIZES:
+            pkt = notif._pack_to_server(1304029911, pynsca.OK,
+                                        'host.example.com', 'service',
+                                        'x' * size)
+            times, elapsed = run_timed(lambda: encrypt(pkt), duration)
+            yield summarize('encrypt', dict(mode=mode,
+                                            password=bool(password),
+                                            output_size=size),
+                            times, elapsed)
+
+
+def bench_send(duration, batch=False):
+    receiver = pynsca.NSCAReceiver('127.0.0.1', 0, callback=lambda r: None,
+                                   max_packet_age=None)
+    receiver.start()
+    try:
+        for senders in SENDERS:
+            notif = pynsca.NSCANotifier('127.0.0.1', receiver.port)
+            all_times = []
+            lock = threading.Lock()
+            per_call = 100 if batch else 1
+
+            def sender():
+                results = [('host.example.com', 'service', pynsca.OK,
+                            'x' * 64)] * per_call
+                if batch:
+                    fn = lambda: notif.svc_results(results)
+                else:
+                    fn = lambda: notif.svc_result(*results[0])
+                times, elapsed = run_timed(fn, duration)
+                lock.acquire()
+                all_times.extend(times)
+                lock.release()
+
+            threads = [threading.Thread(target=sender)
+                       for i in range(senders)]
+            start = clock()
+            for thd in threads:
+                thd.start()
+            for thd in threads:
+                thd.join()
+            elapsed = clock() - start
+            yield summarize(batch and 'send_batch' or 'send',
+                            dict(senders=senders, batch_size=per_call),
+                            all_times, elapsed,
+                            packets=len(all_times) * per_call)
+    finally:
+        receiver.stop()
+
+
+def format_result(result):
+    params = ' '.join(['%s=%s' % (k, result[k]) for k in
+                       ('mode', 'password', 'output_size', 'senders',
+                        'batch_size') if k in result])
+    return '%-10s %-40s %12.0f pkt/s  p50 %9.1fus  p99 %9.1fus' % (
+        result['name'], params, result['packets_per_sec'],
+        result['p50_us'], result['p99_us'])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark pynsca')
+    parser.add_argument('--duration', type=float, default=0.5,
+                        help='seconds to run each benchmark (default 0.5)')
+    parser.add_argument('--json', metavar='FILE',
+                        help='also write results to FILE as JSON')
+    parser.add_argument('--skip-network', action='store_true',
+                        help='only run the encode and encrypt benchmarks')
+    args = parser.parse_args(argv)
+
+    benchmarks = [bench_encode(args.duration), bench_encrypt(args.duration)]
+    if not args.skip_network:
+        benchmarks.append(bench_send(args.duration))
+        benchmarks.append(bench_send(args.duration, batch=True))
+
+    results = []
+    for benchmark in benchmarks:
+        for result in benchmark:
+            print(format_result(result))
+            sys.stdout.flush()
+            results.append(result)
+
+    if args.json:
+        f = open(args.json, 'w')
+        try:
+            json.dump(dict(python=platform.python_version(),
+                           implementation=platform.python_implementation(),
+                           platform=platform.platform(),
+                           results=results), f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+
+
+if __name__ == '__main__':
+    main()
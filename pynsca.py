@@ -25,7 +25,47 @@
 # you do not delete the provisions above, a recipient may use your version of
 # this file under either the MPL or the GPLv2 License.
 
-import struct, binascii, itertools, socket
+import struct, binascii, socket, threading, atexit, collections, time, os, sys
+import mmap, hashlib, bisect, select, errno
+
+try:
+    import queue, socketserver
+except ImportError: # Python 2
+    import Queue as queue, SocketServer as socketserver
+
+# optional encryption libraries
+try:
+    from Crypto.Cipher import DES, DES3, CAST, Blowfish
+except ImportError:
+    DES = DES3 = CAST = Blowfish = None
+try:
+    import mcrypt
+except ImportError:
+    mcrypt = None
+
+try:
+    _text_type = unicode
+except NameError: # Python 3
+    _text_type = str
+
+if hasattr(int, 'from_bytes'): # Python 3
+    def _bytes_to_int(data):
+        return int.from_bytes(data, 'big')
+
+    def _int_to_bytes(value, length):
+        return value.to_bytes(length, 'big')
+
+    def _native_str(field):
+        return field.decode('utf-8', 'replace')
+else:
+    def _bytes_to_int(data):
+        return int(binascii.hexlify(data), 16)
+
+    def _int_to_bytes(value, length):
+        return binascii.unhexlify('%0*x' % (2 * length, value))
+
+    def _native_str(field):
+        return field
 
 
 # return value constants
@@ -37,6 +77,43 @@ UNREACHABLE = 2
 CRITICAL = 2
 UNKNOWN = 3
 
+# a clock for timing intervals
+_clock = getattr(time, 'perf_counter', time.time)
+
+# overflow policies for NSCANotifier.start_queue
+DROP_OLDEST = 'drop-oldest'
+DROP_NEWEST = 'drop-newest'
+BLOCK = 'block'
+
+class NSCASendError(Exception):
+    """
+    A multi-result send failed part-way through.
+
+    @ivar sent: number of packets written to the server before the failure
+    @ivar error: the underlying exception
+    """
+
+    def __init__(self, sent, error):
+        Exception.__init__(self, sent, error)
+        self.sent = sent
+        self.error = error
+
+    def __str__(self):
+        return "failed after sending %d packets: %s" % (self.sent, self.error)
+
+class NSCAPacketError(Exception):
+    """
+    A packet received from a client was corrupt or could not be decrypted,
+    or the banner received from a server was short.
+    """
+
+# a check result, as received by NSCAReceiver
+CheckResult = collections.namedtuple('CheckResult', ['host_name',
+        'svc_description', 'return_code', 'plugin_output', 'timestamp'])
+
+# errors that mean the server could not be reached, as opposed to a bad result
+_network_errors = (socket.error, NSCAPacketError)
+
 class NSCANotifier(object):
     """
     Class to send notifications to a Nagios server via NSCA.
@@ -48,103 +125,272 @@ class NSCANotifier(object):
     fromserver_fmt_size = struct.calcsize(fromserver_fmt)
     toserver_fmt = "!HxxlLH64s128s514s"
     toserver_fmt_size = struct.calcsize(toserver_fmt)
+    toserver_struct = struct.Struct(toserver_fmt)
+
+    # precompiled pieces of toserver_fmt, for patching packets in place
+    toserver_header = struct.Struct("!lLH") # crc32, timestamp, return code
+    toserver_header_offset = struct.calcsize("!Hxx")
+    toserver_crc32 = struct.Struct("!L")
+    toserver_output = struct.Struct("!514s")
+    toserver_output_offset = struct.calcsize("!HxxlLH64s128s")
+
+    # encryption_mode: (cipher, key size), for the modes using PyCrypto
+    crypto_modes = {
+        2: (DES, 8),
+        3: (DES3, 24),
+        4: (CAST, 16),
+        8: (Blowfish, 56),
+    }
+
+    # maximum number of (host, service) packet templates to keep
+    template_cache_size = 1024
 
-    def __init__(self, monitoring_server, monitoring_port=5667, encryption_mode=1, password=None):
+    # when a server has several addresses, how long to wait for a connection
+    # before also trying the next address, in seconds
+    happy_eyeballs_delay = 0.25
+
+    def __init__(self, monitoring_server, monitoring_port=5667, encryption_mode=1, password=None, spool=None,
+                 send_to_all=False, failure_threshold=2, retry_interval=30,
+                 resolver_ttl=60, resolver_negative_ttl=5, rate_controller=None):
+        """
+        @param monitoring_server: the NSCA server's host name, or a list of
+            servers, each a host name or a C{(host, port)} tuple, to try in
+            order
+        @param spool: an L{NSCASpool} to keep results that cannot be sent
+            because of a network error, and to replay them from once the
+            server is reachable again
+        @param send_to_all: with a list of servers, send every result to all
+            of them in parallel, rather than to the first that answers
+        @param failure_threshold: with a list of servers, the number of
+            consecutive failures after which a server is skipped
+        @param retry_interval: how long a failing server is skipped for, in
+            seconds, before one connection is allowed through to probe it
+        @param resolver_ttl: how long the addresses of a server are cached,
+            in seconds.  If they cannot be looked up again, the old
+            addresses keep being used.
+        @param resolver_negative_ttl: how long a failed lookup is cached, in
+            seconds
+        @param rate_controller: a L{RateController}, possibly shared with
+            other notifiers, to limit the rate at which packets are sent
+        """
+        self._servers = None
+        if isinstance(monitoring_server, list):
+            self._servers = []
+            for server in monitoring_server:
+                if isinstance(server, (str, _text_type)):
+                    server = (server, monitoring_port)
+                self._servers.append(_ServerHealth(server, failure_threshold,
+                        retry_interval))
+            monitoring_server, monitoring_port = self._servers[0].address
         self.monitoring_server = monitoring_server
         self.monitoring_port = monitoring_port
         self.encryption_mode = encryption_mode
         self.password = password
+        self.spool = spool
+        self.send_to_all = send_to_all
+        self.rate_controller = rate_controller
+        self._resolver = _ResolverCache(resolver_ttl, resolver_negative_ttl)
+        self._password_masks = {}
+        self._templates = {}
+        self._cipher_contexts = {}
+        self._sender = None
+        self._pool = None
+        self._instrumentation = None
 
     def _decode_from_server(self, bytes):
         iv, timestamp = struct.unpack(self.fromserver_fmt, bytes)
         return iv, timestamp
 
     def _pad_password(self, password, length):
-        return password + ('\0' * (length - len(password)))
-
-    def _apply_cipher(self, cipher, key_size, iv, password, toserver_pkt):
-        import Crypto.Util.randpool
+        password = self._force_str(password or b'')[:length]
+        return password + (b'\0' * (length - len(password)))
 
-        password = self._pad_password(password, key_size)
-        iv_size = cipher.block_size
-        if len(iv) >= iv_size:
-            iv = iv[:iv_size]
+    def _cipher_context(self, mode, password):
+        """
+        Return C{(cipher, key, iv_size)} for one of the block-cipher modes,
+        resolving the cipher and padding the password only once per
+        notifier.  For mode 16, C{cipher} is None if python-mcrypt is used,
+        and otherwise a L{_Rijndael256} holding the expanded key.
+        """
+        key = (mode, password)
+        try:
+            return self._cipher_contexts[key]
+        except KeyError:
+            pass
+        if mode == 16:
+            key = self._pad_password(password, _Rijndael256.key_size)
+            if mcrypt is None:
+                context = (_Rijndael256(key), key, _Rijndael256.block_size)
+            else:
+                context = (None, key, _Rijndael256.block_size)
         else:
-            iv += self.random_pool.get_bytes(iv_size - iv)
-        e = cipher.new(password, cipher.MODE_CFB, iv)
-        return ''.join(e.encrypt(toserver_pkt))
+            cipher, key_size = self.crypto_modes[mode]
+            if cipher is None:
+                raise ImportError("PyCrypto is required for "
+                        "encryption_mode %d" % mode)
+            context = (cipher, self._pad_password(password, key_size),
+                    cipher.block_size)
+        self._cipher_contexts[(mode, password)] = context
+        return context
 
-    def _encrypt_packet(self, toserver_pkt, iv, mode, password):
-        from Crypto.Cipher import DES, DES3, CAST, Blowfish
-        crypto_modes = {
-            2: (DES, 8),
-            3: (DES3, 24),
-            4: (CAST, 16),
-            8: (Blowfish, 56),
-        }
-        if mode in crypto_modes:
-            cipher, key_size = crypto_modes[mode]
-            return self._apply_cipher(cipher, key_size, iv, password, toserver_pkt)
+    def _encryptor(self, iv, mode, password, decrypt=False):
+        """
+        Return a function that encrypts successive packets sent over a
+        connection whose banner carried C{iv}.  Stream ciphers keep their
+        state between calls, so every packet on one connection must go
+        through the same encryptor, in order.  With C{decrypt}, the function
+        decrypts instead, as the server does.
+        """
+        if mode in self.crypto_modes or mode == 16:
+            cipher, key, iv_size = self._cipher_context(mode, password)
+            if len(iv) >= iv_size:
+                iv = iv[:iv_size]
+            else:
+                iv += os.urandom(iv_size - len(iv))
+            if mode == 16:
+                if cipher is not None:
+                    return cipher.cfb8(iv, decrypt)
+                # libmcrypt's cfb mode works a byte at a time internally, so
+                # a whole packet can go in one call
+                m = mcrypt.MCRYPT('rijndael-256', 'cfb')
+                m.init(key, iv)
+                crypt = decrypt and m.decrypt or m.encrypt
+                return lambda data: crypt(bytes(data))
+            e = cipher.new(key, cipher.MODE_CFB, iv)
+            if decrypt:
+                return e.decrypt
+            return e.encrypt
 
         if mode == 1:
-            cycle = [iv]
-            if password:
-                cycle = [iv, password]
-            for key in cycle:
-                toserver_pkt = ''.join([chr(p^i)
-                                for p,i in itertools.izip(
-                                        itertools.imap(ord, toserver_pkt),
-                                        itertools.imap(ord, itertools.cycle(key)))])
-        elif mode == 16:
-            import mcrypt
-            m = mcrypt.MCRYPT('rijndael-256', 'cfb')
-            iv_size = m.get_iv_size()
-            key_size = m.get_key_size()
-            key = ['\0'] * key_size
-            key[0:len(password)] = password
-            m.init(''.join(key), iv[:iv_size])
-            toserver_pkt = ''.join([m.encrypt(x) for x in toserver_pkt])
-        elif mode == 0:
-            return toserver_pkt
-        else:
+            mask = self._xor_mask(iv, password, self.toserver_fmt_size)
+            def encrypt(toserver_pkt):
+                length = len(toserver_pkt)
+                if length == self.toserver_fmt_size:
+                    return self._xor(toserver_pkt, mask)
+                return self._xor(toserver_pkt,
+                        self._xor_mask(iv, password, length))
+            return encrypt
+        elif mode != 0:
             print("no supported encryption_mode")
-        return toserver_pkt
+        return lambda toserver_pkt: toserver_pkt
 
-    def _encode_to_server(self, iv, timestamp, return_code, host_name,
-                         svc_description, plugin_output, mode=1, password=None):
-        # note that this will pad the strings with 0's instead of random digits.  Oh well.
-        toserver = [
-                self.proto_version,
+    def _xor_mask(self, iv, password, length):
+        """
+        Return the XOR keystream for a C{length}-byte packet as a single
+        integer: the IV and the password, each repeated to C{length} bytes,
+        XORed together.  The password half only depends on the notifier's
+        configuration, so it is cached.
+        """
+        mask = self._repeat_key(iv, length)
+        if password:
+            key = (password, length)
+            if key not in self._password_masks:
+                self._password_masks[key] = self._repeat_key(password, length)
+            mask ^= self._password_masks[key]
+        return mask
+
+    def _repeat_key(self, key, length):
+        if not key or not length:
+            return 0
+        key = self._force_str(key)
+        key = (key * (length // len(key) + 1))[:length]
+        return _bytes_to_int(key)
+
+    def _xor(self, toserver_pkt, mask):
+        if not toserver_pkt:
+            return bytes(toserver_pkt)
+        # XOR the whole packet at once, as one big integer
+        return _int_to_bytes(_bytes_to_int(toserver_pkt) ^ mask,
+                len(toserver_pkt))
+
+    def _encrypt_packet(self, toserver_pkt, iv, mode, password):
+        return self._encryptor(iv, mode, password)(toserver_pkt)
+
+    def _pack_to_server(self, timestamp, return_code, host_name,
+                        svc_description, plugin_output):
+        toserver = bytearray(self.toserver_fmt_size)
+        return bytes(self._pack_into(toserver, timestamp, return_code,
+                host_name, svc_description, plugin_output))
+
+    def _pack_into(self, toserver, timestamp, return_code, host_name,
+                   svc_description, plugin_output):
+        """
+        Build an unencrypted packet in C{toserver}, a bytearray of
+        C{toserver_fmt_size} bytes that may be reused from one packet to the
+        next, and return it.
+        """
+        # the host and service fields rarely change, so start from a cached
+        # template with those filled in, and patch the remaining fields in
+        # place.  Note that this will pad the strings with 0's instead of
+        # random digits.  Oh well.
+        toserver[:] = self._template(host_name, svc_description)
+        self.toserver_header.pack_into(toserver, self.toserver_header_offset,
                 0, # crc32_value
                 timestamp,
-                return_code,
+                return_code)
+        self.toserver_output.pack_into(toserver, self.toserver_output_offset,
+                self._escape_newlines(self._force_str(plugin_output)))
+
+        # calculate crc32 and insert it
+        crc32 = binascii.crc32(toserver) & 0xffffffff
+        self.toserver_crc32.pack_into(toserver, self.toserver_header_offset,
+                crc32)
+
+        return toserver
+
+    def _restamp(self, toserver_pkt, timestamp):
+        """
+        Return a copy of an unencrypted packet with a new timestamp (and
+        CRC32).
+        """
+        toserver = bytearray(toserver_pkt)
+        crc32, old_timestamp, return_code = self.toserver_header.unpack_from(
+                toserver, self.toserver_header_offset)
+        self.toserver_header.pack_into(toserver, self.toserver_header_offset,
+                0, timestamp, return_code)
+        self.toserver_crc32.pack_into(toserver, self.toserver_header_offset,
+                binascii.crc32(toserver) & 0xffffffff)
+        return bytes(toserver)
+
+    def _packet_timestamp(self, toserver_pkt):
+        return self.toserver_header.unpack_from(toserver_pkt,
+                self.toserver_header_offset)[1]
+
+    def _template(self, host_name, svc_description):
+        key = (host_name, svc_description)
+        try:
+            return self._templates[key]
+        except KeyError:
+            pass
+        if len(self._templates) >= self.template_cache_size:
+            self._templates.clear()
+        template = self._templates[key] = self.toserver_struct.pack(
+                self.proto_version, 0, 0, 0,
                 self._force_str(host_name),
                 self._force_str(svc_description),
-                self._force_str(self._escape_newlines(plugin_output)),
-        ]
-
-        # calculate crc32 and insert into the list
-        crc32 = binascii.crc32(struct.pack(self.toserver_fmt, *toserver))
-        toserver[1] = crc32
+                b'')
+        return template
 
-        # convert to bytes
-        toserver_pkt = struct.pack(self.toserver_fmt, *toserver)
+    def _encode_to_server(self, iv, timestamp, return_code, host_name,
+                         svc_description, plugin_output, mode=1, password=None):
+        toserver_pkt = self._pack_to_server(timestamp, return_code, host_name,
+                svc_description, plugin_output)
 
         # and encode or encrypt
-        toserver_pkt = self._encrypt_packet(toserver_pkt, iv, mode, password)
-
-        return toserver_pkt
+        return self._encrypt_packet(toserver_pkt, iv, mode, password)
 
     def _escape_newlines(self, text):
         """Escape backslash and newlines; see https://github.com/djmitche/pynsca/issues/12#issuecomment-60086643"""
+        if isinstance(text, bytes):
+            return text.replace(b'\\', b'\\\\').replace(b'\n', b'\\n')
         return text.replace('\\', r'\\').replace('\n', r'\n')
 
     def _force_str(self, text):
-        if isinstance(text, unicode):
+        if isinstance(text, _text_type):
             return text.encode('utf-8')
         return text
 
-    def host_result(self, host_name, return_code, plugin_output):
+    def host_result(self, host_name, return_code, plugin_output, priority=0):
         """
         Send a passive host check to the configured monitoring host
 
@@ -153,10 +399,13 @@ class NSCANotifier(object):
         @param host_name: host containing the service
         @param return_code: result (e.g., C{OK} or C{CRITICAL})
         @param plugin_output: textual output
+        @param priority: see L{svc_result}
         """
-        self.svc_result(host_name, '', return_code, plugin_output)
+        self.svc_result(host_name, '', return_code, plugin_output,
+                priority=priority)
 
-    def svc_result(self, host_name, svc_description, return_code, plugin_output, timeout=5):
+    def svc_result(self, host_name, svc_description, return_code, plugin_output, timeout=5,
+                   priority=0):
         """
         Send a service result to the configured monitoring host
 
@@ -167,25 +416,2711 @@ class NSCANotifier(object):
         @param svc_description: description of the service with the result
         @param return_code: result (e.g., C{OK} or C{CRITICAL})
         @param plugin_output: textual output
+        @param timeout: socket timeout, in seconds; ignored when queued (see
+            L{start_queue})
+        @param priority: when queued, results with a higher priority are
+            sent first; ignored otherwise
+        """
+        if self._sender is not None:
+            self._sender.put((host_name, svc_description, return_code,
+                    plugin_output), priority)
+            return
+        if self.spool is not None or self._sending_to_all():
+            self.svc_results([(host_name, svc_description, return_code,
+                    plugin_output)], timeout)
+            return
+        session = self._acquire(timeout)
+        reusable = False
+        try:
+            session.svc_result(host_name, svc_description, return_code,
+                    plugin_output)
+            reusable = True
+        finally:
+            self._release(session, reusable)
+
+    def svc_results(self, results, timeout=5):
+        """
+        Send many results over a single connection to the monitoring host
+
+        The connection and banner exchange happen once, after which every
+        result is streamed as its own packet, as the C C{send_nsca} does.
+
+        If the notifier has a spool, anything in it is replayed over the
+        same connection first, and results that cannot be sent because of a
+        network error are spooled instead of raising an exception.
+
+        @param results: iterable of C{(host_name, svc_description,
+            return_code, plugin_output)} tuples; use an empty
+            C{svc_description} for host checks
+        @returns: the number of packets sent, not counting any replayed
+            from the spool
+        @raises NSCASendError: if anything fails; its C{sent} attribute
+            gives the number of packets written before the failure
+        """
+        if self._sending_to_all():
+            return self._svc_results_to_all(list(results), timeout)
+        if self.spool is not None:
+            results = list(results)
+        sent = 0
+        try:
+            session = self._acquire(timeout)
+            reusable = False
+            try:
+                if self.spool is not None:
+                    self.spool.replay(session)
+                replayed = session.sent
+                for host_name, svc_description, return_code, plugin_output in results:
+                    session.svc_result(host_name, svc_description, return_code,
+                            plugin_output)
+                    sent = session.sent - replayed
+                reusable = True
+            finally:
+                self._release(session, reusable)
+        except Exception as e:
+            if self.spool is not None and isinstance(e, _network_errors):
+                self.spool.extend(results[sent:])
+                return sent
+            raise NSCASendError(sent, e)
+        return sent
+
+    def dispatch(self, results, connections=4, timeout=5):
+        """
+        Send a batch of results over several connections at once, to make
+        use of more of the server's capacity than one connection can, for
+        instance when catching up after an outage.
+
+        Results for the same host and service always go over the same
+        connection, in the order given, so an older result can never
+        arrive after a newer one.  Each connection is sent from its own
+        thread and has its own encryption state.  Unlike L{svc_results},
+        results are neither replayed from nor written to the spool.
+
+        With C{send_to_all}, each connection's results are sent to every
+        available server, over a connection of their own, and a result
+        counts as sent once any server has it.
+
+        @param results: iterable of C{(host_name, svc_description,
+            return_code, plugin_output)} tuples
+        @param connections: maximum number of connections to use (per
+            server, with C{send_to_all})
+        @param timeout: socket timeout, in seconds
+        @returns: a list with, for each result in order, C{None} if it was
+            sent, or the exception that stopped it from being sent
+        @raises ValueError: if C{connections} is less than 1
+        """
+        if connections < 1:
+            raise ValueError("connections must be at least 1, not %r" %
+                    (connections,))
+        results = list(results)
+        # spread the (host, service) pairs over the connections, in order
+        # of first appearance, keeping each pair on one connection
+        slots = {}
+        batches = [[] for i in range(connections)]
+        for i, result in enumerate(results):
+            key = (result[0], result[1])
+            slot = slots.setdefault(key, len(slots) % connections)
+            batches[slot].append(i)
+        batches = [batch for batch in batches if batch]
+
+        if self._sending_to_all():
+            now = _clock()
+            servers = [server for server in self._servers
+                       if server.available(now)]
+            if not servers:
+                error = socket.error("no NSCA server available")
+                return [error] * len(results)
+        else:
+            # None stands for a session from _acquire
+            servers = [None]
+
+        # for each batch, (sent, error) from each server it was sent to
+        progress = [[] for batch in batches]
+        def send(n, server):
+            sent = 0
+            error = None
+            try:
+                if server is None:
+                    session = self._acquire(timeout)
+                else:
+                    session = NSCASession(self, timeout, server)
+                reusable = False
+                try:
+                    for i in batches[n]:
+                        session.svc_result(*results[i])
+                        sent += 1
+                    reusable = True
+                finally:
+                    if server is None:
+                        self._release(session, reusable)
+                    else:
+                        session.close()
+            except Exception as e:
+                error = e
+            progress[n].append((sent, error))
+
+        threads = [threading.Thread(target=send, args=(n, server))
+                for n in range(len(batches)) for server in servers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        outcomes = [None] * len(results)
+        for batch, sends in zip(batches, progress):
+            sent, error = max(sends, key=lambda outcome: outcome[0])
+            for i in batch[sent:]:
+                outcomes[i] = error
+        return outcomes
+
+    def _sending_to_all(self):
+        return self.send_to_all and self._servers is not None
+
+    def _svc_results_to_all(self, results, timeout):
+        # send the results to every available server, each from its own
+        # thread; a result counts as sent once any server has it
+        outcomes = []
+        def send(server, replay):
+            sent = 0
+            try:
+                session = NSCASession(self, timeout, server)
+                try:
+                    if replay:
+                        self.spool.replay(session)
+                    replayed = session.sent
+                    for result in results:
+                        session.svc_result(*result)
+                        sent = session.sent - replayed
+                finally:
+                    session.close()
+            except Exception as e:
+                outcomes.append((sent, e))
+            else:
+                outcomes.append((sent, None))
+
+        threads = []
+        now = _clock()
+        for server in self._servers:
+            if server.available(now):
+                # the spool is replayed to the first server only
+                replay = self.spool is not None and not threads
+                threads.append(threading.Thread(target=send,
+                        args=(server, replay)))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if not outcomes:
+            outcomes.append((0, socket.error("no NSCA server available")))
+        sent, error = max(outcomes, key=lambda outcome: outcome[0])
+        if sent == len(results):
+            return sent
+        if self.spool is not None and isinstance(error, _network_errors):
+            self.spool.extend(results[sent:])
+            return sent
+        raise NSCASendError(sent, error)
+
+    def server_health(self):
+        """
+        Return the health of each server, when the notifier was given a
+        list of servers, as a list of dictionaries in the order the servers
+        are tried.  Each has keys C{address} (a C{(host, port)} tuple),
+        C{state} (C{'closed'} while the server is in use, C{'open'} while it
+        is skipped, and C{'half-open'} once it may be probed again),
+        C{consecutive_failures}, C{last_error} (the exception, or None) and
+        C{latency}, a moving average of the time to connect and read the
+        server's banner, in seconds, or None before the first success.
+        """
+        if self._servers is None:
+            return []
+        return [server.snapshot() for server in self._servers]
+
+    def start_queue(self, maxsize=10000, overflow=DROP_OLDEST, batch_size=100,
+                    timeout=5, exit_timeout=5, max_delay=10):
+        """
+        Queue results instead of sending them synchronously.
+
+        Once queued, L{svc_result} and L{host_result} only add the result to
+        a bounded queue and return immediately.  A background thread sends
+        queued results in batches, each over a single connection (see
+        L{svc_results}).  Results in a batch that fails are counted in
+        L{queue_stats} and discarded, or spooled if the notifier has a
+        spool.
+
+        Queued results are not sent first-in, first-out: the most urgent
+        go first, ordered by the caller's C{priority}, then by return code
+        (C{CRITICAL}, C{UNKNOWN}, C{WARNING}, then C{OK}).  Among equally
+        urgent results, hosts take turns, so one busy host cannot hold up
+        the others.  A result that has waited C{max_delay} seconds is sent
+        ahead of everything else, so nothing waits forever.  Results for
+        the same host and service are always sent in the order given.
+
+        @param maxsize: maximum number of queued results
+        @param overflow: what to do with a result when the queue is full:
+            C{DROP_OLDEST} discards the oldest of the least urgent queued
+            results, C{DROP_NEWEST} discards the new one, and C{BLOCK} waits
+            for room
+        @param batch_size: maximum number of results sent per connection
+        @param timeout: socket timeout, in seconds
+        @param exit_timeout: how long to wait, at interpreter exit, for
+            queued results to be sent
+        @param max_delay: longest time a result should wait behind more
+            urgent ones, in seconds, or None for no limit
+        """
+        if overflow not in (DROP_OLDEST, DROP_NEWEST, BLOCK):
+            raise ValueError("unknown overflow policy %r" % (overflow,))
+        if self._sender is not None:
+            raise RuntimeError("queue already started")
+        self._sender = _SenderThread(self, maxsize, overflow, batch_size,
+                timeout, exit_timeout, max_delay)
+        self._sender.start()
+
+    def flush(self, timeout=None):
+        """
+        Wait until every queued result has been sent (or has failed).
+
+        @param timeout: maximum time to wait, in seconds, or None to wait
+            forever
+        @returns: True if the queue was drained, False on timeout
+        """
+        if self._sender is None:
+            return True
+        return self._sender.flush(timeout)
+
+    def stop_queue(self, timeout=None):
+        """
+        Flush the queue, then stop the background thread and return to
+        sending results synchronously.  Results still queued after
+        C{timeout} are discarded.
+
+        @returns: True if the queue was drained, False on timeout
+        """
+        sender = self._sender
+        if sender is None:
+            return True
+        self._sender = None
+        return sender.stop(timeout)
+
+    def queue_stats(self):
+        """
+        Return a dictionary of counters for the queue: C{queued} (currently
+        waiting), C{sent}, C{dropped} (on overflow), C{failed} and
+        C{overdue} (results sent early because they had waited
+        C{max_delay}).
+        """
+        if self._sender is None:
+            return dict(queued=0, sent=0, dropped=0, failed=0, overdue=0)
+        return self._sender.stats()
+
+    def start_pool(self, size=2, max_age=20, idle_timeout=60, timeout=5):
+        """
+        Keep connections open, ready to send.
+
+        A background thread keeps up to C{size} connections open with the
+        server's banner already read, so that L{svc_result} and
+        L{svc_results} only have to encode, encrypt and send.  Connections
+        are returned to the pool after use, and are replaced once the
+        server's timestamp in their banner is C{max_age} seconds old (keep
+        this below the server's C{max_packet_age}), or once they have been
+        idle for C{idle_timeout} seconds.  Connections the server has closed
+        are noticed and replaced before they are handed out.  When the pool
+        is empty, a new connection is opened as usual.
+
+        @param size: number of connections to keep open
+        @param max_age: maximum age of a connection, in seconds
+        @param idle_timeout: maximum time a connection may sit unused
+        @param timeout: socket timeout for the pool's connections, in
+            seconds
+        """
+        if self._pool is not None:
+            raise RuntimeError("pool already started")
+        self._pool = _SessionPool(self, size, max_age, idle_timeout, timeout)
+        self._pool.start()
+
+    def stop_pool(self):
+        """
+        Close the pool's connections and stop its background thread; see
+        L{start_pool}.
+        """
+        pool = self._pool
+        if pool is not None:
+            self._pool = None
+            pool.stop()
+
+    def pool_stats(self):
+        """
+        Return a dictionary of counters for the pool: C{size} (configured),
+        C{ready} (connections currently open and unused), C{hits} and
+        C{misses} (sends that found, or did not find, a ready connection),
+        C{replaced} (connections closed for age or idleness, or by the
+        server) and
+        C{failures} (connections that could not be opened).
+        """
+        if self._pool is None:
+            return dict(size=0, ready=0, hits=0, misses=0, replaced=0,
+                    failures=0)
+        return self._pool.stats()
+
+    def _acquire(self, timeout):
+        pool = self._pool
+        if pool is not None:
+            session = pool.get()
+            if session is not None:
+                return session
+        return self.session(timeout)
+
+    def _release(self, session, reusable):
+        # return a session to the pool, if there is one; the pool closes
+        # sessions that are not reusable
+        pool = self._pool
+        if pool is not None:
+            pool.put(session, reusable)
+        else:
+            session.close()
+
+    def enable_instrumentation(self, timing_hook=None):
+        """
+        Start counting sends and failures, and optionally timing each send.
+
+        The timing hook is called after every packet is sent, with a
+        dictionary of durations in seconds for the C{encode}, C{encrypt} and
+        C{send} phases.  For the first packet on each connection, the
+        dictionary also has C{connect} (including name resolution) and
+        C{banner} (waiting for the server's IV and timestamp).  The hook is
+        called from the sending thread.
+
+        Instrumentation is off by default, and costs one attribute check per
+        packet while off.
+
+        @param timing_hook: callable taking a dictionary of phase durations
+        """
+        self._instrumentation = _Instrumentation(timing_hook)
+
+    def disable_instrumentation(self):
+        """
+        Stop counting and timing sends; see L{enable_instrumentation}.
+        """
+        self._instrumentation = None
+
+    def stats(self):
+        """
+        Return a snapshot of the instrumentation counters, or None if
+        instrumentation is not enabled.  The snapshot is a dictionary with
+        keys C{connections}, C{sends} (packets), C{bytes}, C{timeouts},
+        C{short_banners}, and C{failures}, a dictionary mapping exception
+        class names to counts.
+        """
+        instrumentation = self._instrumentation
+        if instrumentation is None:
+            return None
+        return instrumentation.snapshot()
+
+    def session(self, timeout=5):
         """
-        sk = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        Open a connection to the configured monitoring host, over which any
+        number of results can then be sent.  The returned L{NSCASession} can
+        be used as a context manager.
+
+        @param timeout: socket timeout, in seconds
+        """
+        return NSCASession(self, timeout)
+
+    def _connect(self, timeout, address=None):
+        if address is None:
+            address = (self.monitoring_server, self.monitoring_port)
+        addrinfos = self._resolver.resolve(*address)
+        if len(addrinfos) > 1:
+            return _happy_eyeballs(addrinfos, timeout,
+                    self.happy_eyeballs_delay)
+        family, socktype, proto, canonname, sockaddr = addrinfos[0]
+        sk = socket.socket(family, socktype, proto)
         sk.settimeout(timeout)
-        sk.connect((self.monitoring_server, self.monitoring_port))
+        try:
+            sk.connect(sockaddr)
+        except:
+            sk.close()
+            raise
+        return sk
+
+    def _read_banner(self, sk):
+        buf = _recv_exactly(sk, self.fromserver_fmt_size)
+        if len(buf) < self.fromserver_fmt_size:
+            raise NSCAPacketError("short banner (%d bytes)" % len(buf))
+        return self._decode_from_server(buf)
+
+    def _unpack_to_server(self, toserver_pkt):
+        """
+        Decode a decrypted packet, as the server does, returning a
+        L{CheckResult}.  Raises L{NSCAPacketError} if the packet is
+        corrupt.
+        """
+        if len(toserver_pkt) != self.toserver_fmt_size:
+            raise NSCAPacketError("short packet (%d bytes)" % len(toserver_pkt))
+        (version, crc32, timestamp, return_code, host_name, svc_description,
+                plugin_output) = self.toserver_struct.unpack(toserver_pkt)
+        if version != self.proto_version:
+            raise NSCAPacketError("bad protocol version %d" % version)
+        toserver = bytearray(toserver_pkt)
+        self.toserver_crc32.pack_into(toserver, self.toserver_header_offset, 0)
+        if binascii.crc32(toserver) & 0xffffffff != crc32 & 0xffffffff:
+            raise NSCAPacketError("bad CRC32")
+        return CheckResult(self._strip_nuls(host_name),
+                self._strip_nuls(svc_description), return_code,
+                self._strip_nuls(plugin_output), timestamp)
+
+    def _strip_nuls(self, field):
+        # text fields come back as native strings, as they were sent
+        return _native_str(field.split(b'\0', 1)[0])
+
+
+class NSCASession(object):
+    """
+    A single connection to an NSCA server, carrying any number of results.
+
+    The server's IV and timestamp are read once, when the session is opened,
+    and every result is then encoded against them.  Create sessions with
+    L{NSCANotifier.session}.
+
+    @ivar sent: number of packets sent so far
+    """
+
+    def __init__(self, notifier, timeout=5, server=None):
+        self.notifier = notifier
+        self.sent = 0
+        self.sock = None
+        self.address = None
+        self._opened = _clock()
+        self._last_used = self._opened
+        # every packet on this session is built in the same buffer
+        self._buffer = bytearray(notifier.toserver_fmt_size)
+        self._instrumentation = instrumentation = notifier._instrumentation
+        self._rate = rate = notifier.rate_controller
+        self._phases = None
+        if rate is not None:
+            rate.acquire()
+        start = _clock()
+        try:
+            if server is not None:
+                self._open_server(server, timeout)
+            elif notifier._servers is None:
+                self._open(timeout)
+            else:
+                self._failover(timeout)
+        except:
+            error = sys.exc_info()[1]
+            if instrumentation is not None:
+                instrumentation.failed(error)
+            if rate is not None and isinstance(error, _network_errors):
+                rate.record(error=error)
+            self.close()
+            raise
+        if rate is not None:
+            rate.record(_clock() - start)
+        self._encrypt = notifier._encryptor(self.iv,
+                notifier.encryption_mode, notifier.password)
+
+    def _open(self, timeout, address=None):
+        notifier = self.notifier
+        if self._instrumentation is None:
+            self.sock = notifier._connect(timeout, address)
+            self.iv, self.timestamp = notifier._read_banner(self.sock)
+        else:
+            start = _clock()
+            self.sock = notifier._connect(timeout, address)
+            connected = _clock()
+            self.iv, self.timestamp = notifier._read_banner(self.sock)
+            self._phases = dict(connect=connected - start,
+                    banner=_clock() - connected)
+            self._instrumentation.connected()
+        self.address = address
+
+    def _open_server(self, server, timeout):
+        start = _clock()
+        try:
+            self._open(timeout, server.address)
+        except _network_errors as e:
+            server.failed(e)
+            raise
+        server.succeeded(_clock() - start)
+
+    def _failover(self, timeout):
+        # try each server that is not being skipped, in order; servers are
+        # checked lazily, so that only a server actually tried is probed
+        error = None
+        for server in self.notifier._servers:
+            if not server.available(_clock()):
+                continue
+            try:
+                self._open_server(server, timeout)
+                return
+            except _network_errors as e:
+                error = e
+                self.close()
+        if error is None:
+            error = socket.error("no NSCA server available")
+        raise error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def host_result(self, host_name, return_code, plugin_output):
+        """
+        Send a passive host check over this session; see
+        L{NSCANotifier.host_result}.
+        """
+        self.svc_result(host_name, '', return_code, plugin_output)
+
+    def svc_result(self, host_name, svc_description, return_code, plugin_output):
+        """
+        Send a service result over this session; see
+        L{NSCANotifier.svc_result}.
+        """
+        if self._instrumentation is not None or self._rate is not None:
+            return self._timed_svc_result(host_name, svc_description,
+                    return_code, plugin_output)
+        toserver_pkt = self.notifier._pack_into(self._buffer, self.timestamp,
+                return_code, host_name, svc_description, plugin_output)
+        self.sock.sendall(memoryview(self._encrypt(toserver_pkt)))
+        self.sent += 1
+
+    def _send_packet(self, toserver_pkt):
+        # send an already-encoded, unencrypted packet
+        self._send_encrypted(self._encrypt(toserver_pkt))
+
+    def _send_encrypted(self, data, packets=1):
+        # send already-encrypted packets, taking a token for each from the
+        # rate controller and reporting the outcome to it
+        rate = self._rate
+        if rate is None:
+            self.sock.sendall(data)
+            self.sent += packets
+            return
+        rate.acquire(packets)
+        try:
+            self.sock.sendall(data)
+        except _network_errors as e:
+            rate.record(error=e)
+            raise
+        self.sent += packets
+        rate.record()
+
+    def _timed_svc_result(self, host_name, svc_description, return_code,
+                          plugin_output):
+        # the slow path, taken when timing sends or limiting their rate
+        instrumentation = self._instrumentation
+        rate = self._rate
+        phases = self._phases or {}
+        self._phases = None
+        if rate is not None:
+            rate.acquire()
+        try:
+            start = _clock()
+            toserver_pkt = self.notifier._pack_into(self._buffer,
+                    self.timestamp, return_code, host_name, svc_description,
+                    plugin_output)
+            encoded = _clock()
+            toserver_pkt = self._encrypt(toserver_pkt)
+            encrypted = _clock()
+            self.sock.sendall(memoryview(toserver_pkt))
+            sent = _clock()
+        except:
+            error = sys.exc_info()[1]
+            if instrumentation is not None:
+                instrumentation.failed(error)
+            if rate is not None and isinstance(error, _network_errors):
+                rate.record(error=error)
+            raise
+        self.sent += 1
+        if rate is not None:
+            rate.record()
+        if instrumentation is None:
+            return
+        phases['encode'] = encoded - start
+        phases['encrypt'] = encrypted - encoded
+        phases['send'] = sent - encrypted
+        instrumentation.packet_sent(phases, len(toserver_pkt))
+
+    def close(self):
+        """
+        Close the connection.  Closing an already-closed session is harmless.
+        """
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+class CoalescingNotifier(object):
+    """
+    Wrapper around a notifier that drops results which repeat the last one
+    sent for the same host and service.
+
+    A result is forwarded when its return code or output differs from the
+    last result forwarded for that host and service, or when C{heartbeat}
+    seconds have passed since then, so that Nagios freshness checks are
+    still satisfied.  At most C{max_entries} host/service pairs are
+    remembered; the least recently forwarded are forgotten first, and
+    entries older than the heartbeat are discarded as they are found.
+
+    Results are only remembered once the wrapped notifier has accepted them
+    without raising an error, so a failed send is not suppressed when
+    retried.  If the wrapped notifier is queued (see
+    L{NSCANotifier.start_queue}), that happens as soon as a result is
+    queued, so a result that is later dropped or fails to send is still
+    suppressed until it changes or the heartbeat comes round.
+    """
+
+    def __init__(self, notifier, heartbeat=300, max_entries=10000):
+        """
+        @param notifier: the L{NSCANotifier} (or similar) to forward to
+        @param heartbeat: seconds after which an unchanged result is sent
+            again, or None to only send changes
+        @param max_entries: maximum number of host/service pairs to remember
+        """
+        self.notifier = notifier
+        self.heartbeat = heartbeat
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        # (host_name, svc_description) -> (return_code, plugin_output, time),
+        # in the order they were last forwarded
+        self._last = collections.OrderedDict()
+        self._forwarded = self._suppressed = self._evicted = 0
+
+    def host_result(self, host_name, return_code, plugin_output):
+        """
+        Send a passive host check unless it repeats the last one; see
+        L{NSCANotifier.host_result}.
+
+        @returns: True if the result was forwarded
+        """
+        return self.svc_result(host_name, '', return_code, plugin_output)
+
+    def svc_result(self, host_name, svc_description, return_code,
+                   plugin_output, *args, **kwargs):
+        """
+        Send a service result unless it repeats the last one; see
+        L{NSCANotifier.svc_result}.  Extra arguments are passed to the
+        wrapped notifier.
+
+        @returns: True if the result was forwarded
+        """
+        result = (host_name, svc_description, return_code, plugin_output)
+        if not self._changed([result]):
+            return False
+        self.notifier.svc_result(*(result + args), **kwargs)
+        self._remember([result])
+        return True
+
+    def svc_results(self, results, *args, **kwargs):
+        """
+        Send many results over one connection, leaving out those that repeat
+        the last result for their host and service; see
+        L{NSCANotifier.svc_results}.
+
+        @returns: the number of packets sent
+        """
+        results = self._changed(list(results))
+        if not results:
+            return 0
+        try:
+            sent = self.notifier.svc_results(results, *args, **kwargs)
+        except NSCASendError as e:
+            self._remember(results[:e.sent])
+            raise
+        self._remember(results)
+        return sent
+
+    def stats(self):
+        """
+        Return a dictionary of counters: C{forwarded} and C{suppressed}
+        results, C{entries} currently remembered, and C{evicted} entries.
+        """
+        self._lock.acquire()
+        try:
+            return dict(forwarded=self._forwarded,
+                    suppressed=self._suppressed, entries=len(self._last),
+                    evicted=self._evicted)
+        finally:
+            self._lock.release()
+
+    def _changed(self, results):
+        # return the results that should be forwarded
+        now = _clock()
+        changed = []
+        self._lock.acquire()
+        try:
+            for result in results:
+                last = self._last.get(result[:2])
+                if (last is None or last[:2] != result[2:] or
+                        (self.heartbeat is not None and
+                         now - last[2] >= self.heartbeat)):
+                    changed.append(result)
+                else:
+                    self._suppressed += 1
+        finally:
+            self._lock.release()
+        return changed
+
+    def _remember(self, results):
+        now = _clock()
+        last = self._last
+        self._lock.acquire()
+        try:
+            for result in results:
+                key = result[:2]
+                last.pop(key, None)
+                last[key] = (result[2], result[3], now)
+            self._forwarded += len(results)
+
+            # evict expired entries, then the least recently forwarded
+            if self.heartbeat is not None:
+                while last:
+                    key = next(iter(last))
+                    if now - last[key][2] < self.heartbeat:
+                        break
+                    del last[key]
+                    self._evicted += 1
+            while len(last) > self.max_entries:
+                last.popitem(last=False)
+                self._evicted += 1
+        finally:
+            self._lock.release()
+
+class ShardedNotifier(object):
+    """
+    Notifier that spreads hosts across several NSCA servers, such as the
+    pollers of a distributed Nagios setup, so that each receives only the
+    results for its own hosts.
+
+    Results are routed on their host name using a consistent-hash ring,
+    with C{replicas} points on the ring for each shard, so adding or
+    removing a shard only moves the hosts that land on its points.  Each
+    shard is a full notifier, with its own queue, pool, spool or failover
+    settings.
+    """
+
+    def __init__(self, shards, replicas=160):
+        """
+        @param shards: dictionary mapping a shard name to the
+            L{NSCANotifier} (or similar) for that shard.  Hosts are assigned
+            by name, so a shard keeps its hosts even if its address
+            changes.
+        @param replicas: number of points on the ring for each shard
+        """
+        self.replicas = replicas
+        self._lock = threading.Lock()
+        # (points, shard name at each point, shards), replaced as a whole
+        # when shards are added or removed
+        self._ring = self._build_ring(dict(shards))
+
+    def add_shard(self, name, notifier):
+        """
+        Add a shard, taking over the hosts that now hash to it.
+        """
+        self._lock.acquire()
+        try:
+            shards = dict(self._ring[2])
+            shards[name] = notifier
+            self._ring = self._build_ring(shards)
+        finally:
+            self._lock.release()
+
+    def remove_shard(self, name):
+        """
+        Remove a shard, spreading its hosts over the remaining shards.
+
+        @returns: the shard's notifier
+        """
+        self._lock.acquire()
+        try:
+            shards = dict(self._ring[2])
+            notifier = shards.pop(name)
+            self._ring = self._build_ring(shards)
+        finally:
+            self._lock.release()
+        return notifier
+
+    def shards(self):
+        """
+        Return a dictionary mapping shard names to notifiers.
+        """
+        return dict(self._ring[2])
+
+    def shard_for(self, host_name):
+        """
+        Return the name of the shard that receives results for a host.
+        """
+        return self._lookup(self._ring, host_name)
+
+    def _lookup(self, ring, host_name):
+        points, names, shards = ring
+        if not points:
+            raise LookupError("no shards")
+        i = bisect.bisect(points, self._hash(host_name))
+        if i == len(points):
+            i = 0
+        return names[i]
+
+    def host_result(self, host_name, return_code, plugin_output, *args,
+                    **kwargs):
+        """
+        Send a passive host check to the host's shard; see
+        L{NSCANotifier.host_result}.
+        """
+        self.svc_result(host_name, '', return_code, plugin_output, *args,
+                **kwargs)
+
+    def svc_result(self, host_name, svc_description, return_code,
+                   plugin_output, *args, **kwargs):
+        """
+        Send a service result to the host's shard; see
+        L{NSCANotifier.svc_result}.  Extra arguments are passed to the
+        shard's notifier.
+        """
+        ring = self._ring
+        notifier = ring[2][self._lookup(ring, host_name)]
+        return notifier.svc_result(host_name, svc_description, return_code,
+                plugin_output, *args, **kwargs)
+
+    def svc_results(self, results, *args, **kwargs):
+        """
+        Send many results, as one batch per shard; see
+        L{NSCANotifier.svc_results}.  Every shard's batch is attempted even
+        if another shard fails.
+
+        @returns: the number of packets sent
+        @raises NSCASendError: if any shard fails; its C{sent} attribute is
+            the total sent across all shards, and its C{error} the first
+            shard's error
+        """
+        ring = self._ring
+        batches = collections.OrderedDict()
+        for result in results:
+            batches.setdefault(self._lookup(ring, result[0]), []).append(result)
+        sent = 0
+        error = None
+        for name, batch in batches.items():
+            try:
+                sent += ring[2][name].svc_results(batch, *args, **kwargs)
+            except NSCASendError as e:
+                sent += e.sent
+                if error is None:
+                    error = e.error
+        if error is not None:
+            raise NSCASendError(sent, error)
+        return sent
+
+    def _build_ring(self, shards):
+        ring = []
+        for name in shards:
+            for replica in range(self.replicas):
+                ring.append((self._hash('%s#%d' % (name, replica)), name))
+        ring.sort()
+        return ([point for point, name in ring],
+                [name for point, name in ring], shards)
+
+    def _hash(self, key):
+        if isinstance(key, _text_type):
+            key = key.encode('utf-8')
+        return struct.unpack('!Q', hashlib.md5(key).digest()[:8])[0]
+
+class RateController(object):
+    """
+    Adaptive limit on the rate at which packets are sent, to be shared by
+    the notifiers (and threads) of a process so that together they back off
+    before the NSCA server is overwhelmed; see the C{rate_controller}
+    argument to L{NSCANotifier}.
+
+    This is a token bucket: opening a connection or sending a packet takes
+    a token, tokens are added at C{rate} per second, and at most C{burst}
+    are saved up.  The rate is adjusted AIMD-style from the latency of
+    opening a connection (connecting and reading the server's banner), as
+    reported by the notifiers.  Each connection counts once, however many
+    packets it carries: sending only fills the socket's buffer, so its
+    latency says little about the server.  While the moving average of the
+    latency stays under C{target_latency}, the rate grows by about
+    C{increase} packets per second each second.  When the average goes
+    over the target, or a connection or send fails or times out, the rate
+    is multiplied by C{decrease}, at most once every C{cooldown} seconds.
+    """
+
+    # weight of the newest sample in the latency moving average
+    latency_weight = 0.2
+
+    def __init__(self, rate=100, min_rate=1, max_rate=10000, burst=10,
+                 target_latency=0.5, increase=10, decrease=0.5, cooldown=1):
+        self.rate = float(rate)
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.burst = burst
+        self.target_latency = target_latency
+        self.increase = increase
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._tokens = float(burst)
+        self._refilled = _clock()
+        self._last_decrease = None
+        self._latency = None
+        self._acquired = self._throttled = self._decreases = self._errors = 0
+        self._throttle_time = 0.0
+
+    def acquire(self, tokens=1):
+        """
+        Take C{tokens} from the bucket, waiting until they are available.
+
+        @returns: the time spent waiting, in seconds
+        @raises ValueError: if C{tokens} is more than C{burst}, since they
+            could never all be available at once
+        """
+        if tokens > self.burst:
+            raise ValueError("cannot take %d tokens from a bucket of %d" %
+                    (tokens, self.burst))
+        waited = 0.0
+        while 1:
+            self._lock.acquire()
+            try:
+                now = _clock()
+                self._refill(now)
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    self._acquired += tokens
+                    if waited:
+                        self._throttled += 1
+                        self._throttle_time += waited
+                    return waited
+                wait = (tokens - self._tokens) / self.rate
+            finally:
+                self._lock.release()
+            time.sleep(wait)
+            waited += wait
+
+    def record(self, latency=None, error=None):
+        """
+        Report the outcome of a network operation: the C{latency} of
+        opening a connection, in seconds, the C{error} raised by a
+        connection or send that failed, or neither for a packet that was
+        sent.
+        """
+        self._lock.acquire()
+        try:
+            now = _clock()
+            self._refill(now)
+            if error is not None:
+                self._errors += 1
+                self._slow_down(now)
+                return
+            if latency is not None:
+                if self._latency is None:
+                    self._latency = latency
+                else:
+                    self._latency += self.latency_weight * (latency -
+                            self._latency)
+            if (self._latency is not None and
+                    self._latency > self.target_latency):
+                self._slow_down(now)
+            else:
+                # about `increase` per second when sending at the full rate
+                self.rate = min(self.max_rate,
+                        self.rate + self.increase / self.rate)
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        """
+        Return a dictionary with the current C{rate}, C{tokens} available
+        and connection C{latency} moving average, and counters of tokens C{acquired},
+        acquisitions C{throttled} and the C{throttle_time} they spent
+        waiting, C{errors} reported and rate C{decreases}.
+        """
+        self._lock.acquire()
+        try:
+            self._refill(_clock())
+            return dict(rate=self.rate, tokens=self._tokens,
+                    latency=self._latency, acquired=self._acquired,
+                    throttled=self._throttled,
+                    throttle_time=self._throttle_time, errors=self._errors,
+                    decreases=self._decreases)
+        finally:
+            self._lock.release()
+
+    def _refill(self, now):
+        # call with self._lock held
+        self._tokens = min(self.burst,
+                self._tokens + (now - self._refilled) * self.rate)
+        self._refilled = now
+
+    def _slow_down(self, now):
+        # call with self._lock held
+        if (self._last_decrease is not None and
+                now - self._last_decrease < self.cooldown):
+            return
+        self._last_decrease = now
+        self._decreases += 1
+        self.rate = max(self.min_rate, self.rate * self.decrease)
+
+class NSCASpool(object):
+    """
+    A fixed-size ring of results on disk, for results that could not be
+    sent; see the C{spool} argument to L{NSCANotifier}.
+
+    The file is memory-mapped, and holds a small header followed by
+    C{capacity} records.  Each record is an unencrypted packet in the
+    C{toserver_fmt} layout, so it keeps the result's original timestamp.
+    The spool survives a restart of the process, but it is not flushed to
+    disk on every write, and only one process may use a spool file at a
+    time.
+
+    When the spool is full, C{overflow} decides whether the oldest record
+    is overwritten (C{DROP_OLDEST}) or the new result is discarded
+    (C{DROP_NEWEST}).
+    """
+
+    magic = b'PYNSCASP'
+    header = struct.Struct("!8sLLL") # magic, capacity, first, count
+
+    def __init__(self, path, capacity=10000, overflow=DROP_OLDEST,
+                 max_packet_age=30):
+        """
+        @param path: the spool file, created if it does not exist
+        @param capacity: number of records; ignored for an existing file
+        @param overflow: C{DROP_OLDEST} or C{DROP_NEWEST}
+        @param max_packet_age: on replay, records older than this many
+            seconds, relative to the server's clock, are sent with the
+            server's timestamp instead of their own, since the nsca daemon
+            would otherwise reject them.  This should match the daemon's
+            C{max_packet_age}.
+        """
+        if overflow not in (DROP_OLDEST, DROP_NEWEST):
+            raise ValueError("unknown overflow policy %r" % (overflow,))
+        self.path = path
+        self.overflow = overflow
+        self.max_packet_age = max_packet_age
+        self.codec = NSCANotifier(None)
+        self.record_size = self.codec.toserver_fmt_size
+        self._lock = threading.Lock()
+        self._replay_lock = threading.Lock()
+        # records ever removed from the front, so a replay can tell whether
+        # the record it is sending was dropped by an append in the meantime
+        self._removed = 0
+        # the value of _removed when the record being replayed was read, or
+        # None when no replay is sending
+        self._in_flight = None
+        self.dropped = self.replayed = 0
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            size = os.fstat(fd).st_size
+            if size == 0:
+                size = self.header.size + capacity * self.record_size
+                os.ftruncate(fd, size)
+                self._map = mmap.mmap(fd, size)
+                self._first = self._count = 0
+                self.capacity = capacity
+                self._write_header()
+            else:
+                if size < self.header.size:
+                    raise ValueError("%s is not a pynsca spool" % (path,))
+                self._map = mmap.mmap(fd, size)
+                magic, self.capacity, self._first, self._count = \
+                        self.header.unpack_from(self._map, 0)
+                if (magic != self.magic or size != self.header.size +
+                        self.capacity * self.record_size):
+                    self._map.close()
+                    raise ValueError("%s is not a pynsca spool" % (path,))
+        finally:
+            os.close(fd)
+
+    def __len__(self):
+        return self._count
+
+    def append(self, host_name, svc_description, return_code, plugin_output,
+               timestamp=None):
+        """
+        Add a result to the spool, timestamped now unless C{timestamp} is
+        given.
 
-        # read packet
-        buf = ''
-        while len(buf) < self.fromserver_fmt_size:
-            data = sk.recv(self.fromserver_fmt_size - len(buf))
-            if not data:
+        @returns: False if the spool was full and the result was dropped
+        """
+        if timestamp is None:
+            timestamp = int(time.time())
+        return self._append_packet(self.codec._pack_to_server(timestamp,
+                return_code, host_name, svc_description, plugin_output))
+
+    def _append_packet(self, toserver_pkt):
+        # add an already-encoded, unencrypted packet
+        self._lock.acquire()
+        try:
+            if self._count == self.capacity:
+                if self.overflow == DROP_NEWEST:
+                    self.dropped += 1
+                    return False
+                # a record that is being replayed is only counted as
+                # dropped if its send then fails
+                if self._in_flight != self._removed:
+                    self.dropped += 1
+                self._first = (self._first + 1) % self.capacity
+                self._count -= 1
+                self._removed += 1
+            offset = self._offset((self._first + self._count) % self.capacity)
+            self._map[offset:offset + self.record_size] = toserver_pkt
+            self._count += 1
+            self._write_header()
+        finally:
+            self._lock.release()
+        return True
+
+    def extend(self, results):
+        """
+        Add C{(host_name, svc_description, return_code, plugin_output)}
+        tuples to the spool.
+        """
+        for result in results:
+            self.append(*result)
+
+    def replay(self, session):
+        """
+        Send every spooled result, oldest first, over an open
+        L{NSCASession}, removing each from the spool once it is sent.  Only
+        one replay runs at a time; concurrent callers wait for it.
+
+        @returns: the number of results replayed
+        """
+        replayed = 0
+        self._replay_lock.acquire()
+        try:
+            while 1:
+                self._lock.acquire()
+                try:
+                    if not self._count:
+                        return replayed
+                    offset = self._offset(self._first)
+                    toserver_pkt = self._map[offset:offset + self.record_size]
+                    removed = self._in_flight = self._removed
+                finally:
+                    self._lock.release()
+
+                if (self.max_packet_age is not None and session.timestamp -
+                        self.codec._packet_timestamp(toserver_pkt) >
+                        self.max_packet_age):
+                    toserver_pkt = self.codec._restamp(toserver_pkt,
+                            session.timestamp)
+                try:
+                    session._send_packet(toserver_pkt)
+                except:
+                    self._lock.acquire()
+                    try:
+                        self._in_flight = None
+                        if self._removed != removed:
+                            # dropped from the spool while it was being sent
+                            self.dropped += 1
+                    finally:
+                        self._lock.release()
+                    raise
+                replayed += 1
+
+                self._lock.acquire()
+                try:
+                    self._in_flight = None
+                    self.replayed += 1
+                    if self._removed == removed:
+                        self._first = (self._first + 1) % self.capacity
+                        self._count -= 1
+                        self._removed += 1
+                        self._write_header()
+                finally:
+                    self._lock.release()
+        finally:
+            self._replay_lock.release()
+
+    def stats(self):
+        """
+        Return a dictionary of counters: C{spooled} (currently held),
+        C{dropped} on overflow and C{replayed}.
+        """
+        return dict(spooled=self._count, dropped=self.dropped,
+                replayed=self.replayed)
+
+    def flush(self):
+        """
+        Write the spool to disk.
+        """
+        self._map.flush()
+
+    def close(self):
+        """
+        Flush and close the spool.
+        """
+        self._map.flush()
+        self._map.close()
+
+    def _offset(self, index):
+        return self.header.size + index * self.record_size
+
+    def _write_header(self):
+        self.header.pack_into(self._map, 0, self.magic, self.capacity,
+                self._first, self._count)
+
+
+class NSCARelay(object):
+    """
+    A local relay, listening on a Unix socket, that forwards results from
+    many processes to an NSCA server over a few long-lived connections.
+
+    Clients (see L{RelayNotifier}) write each result as a fixed-size frame
+    holding an unencrypted NSCA packet, so sending a result costs a client
+    one local write.  The relay checks each frame's CRC, then queues it for
+    one of C{connections} upstream threads.  Each thread keeps an
+    L{NSCASession} open and replaces it after C{session_lifetime} seconds
+    or on error.  Frames that cannot be forwarded are written to the
+    upstream notifier's spool, if it has one, and are otherwise counted as
+    failed and dropped.  When the queue is full, reading from clients
+    pauses.
+
+    See L{relay_main} for a command-line entry point.
+    """
+
+    def __init__(self, socket_path, notifier, connections=2, queue_size=10000,
+                 session_lifetime=60, max_packet_age=30, timeout=5):
+        """
+        @param socket_path: path of the Unix socket to listen on; an
+            existing file there is removed
+        @param notifier: L{NSCANotifier} for the upstream server
+        @param connections: number of upstream connections
+        @param queue_size: maximum number of results waiting to be
+            forwarded
+        @param session_lifetime: seconds after which an upstream connection
+            is replaced
+        @param max_packet_age: results older than this many seconds,
+            relative to the server's clock, are forwarded with the
+            server's timestamp instead of their own
+        @param timeout: upstream socket timeout, in seconds
+        """
+        self.socket_path = socket_path
+        self.notifier = notifier
+        self.connections = connections
+        self.session_lifetime = session_lifetime
+        self.max_packet_age = max_packet_age
+        self.timeout = timeout
+        self.codec = NSCANotifier(None)
+        self.queue = queue.Queue(queue_size)
+
+        self._lock = threading.Lock()
+        self._stats = dict(clients=0, received=0, rejected=0, forwarded=0,
+                spooled=0, failed=0)
+        self._stopping = threading.Event()
+        self._threads = []
+        self._clients = set()
+
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        self.server = _RelayServer(socket_path, _RelayHandler)
+        self.server.relay = self
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        """
+        Start the relay, from background threads.
+        """
+        thd = threading.Thread(target=self.server.serve_forever, args=(0.1,),
+                name='pynsca-relay')
+        self._threads.append(thd)
+        for i in range(self.connections):
+            self._threads.append(threading.Thread(target=self._forward,
+                    name='pynsca-relay-upstream'))
+        for thd in self._threads:
+            thd.daemon = True
+            thd.start()
+
+    def serve_forever(self):
+        """
+        Run the relay until interrupted.
+        """
+        self.start()
+        try:
+            while not self._stopping.is_set():
+                self._stopping.wait(1)
+        finally:
+            self.stop()
+
+    def stop(self, timeout=5):
+        """
+        Stop accepting results, forward what is queued (waiting up to
+        C{timeout} seconds), and close the upstream connections.
+        """
+        if self._threads:
+            self.server.shutdown()
+        self.server.server_close()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        self._lock.acquire()
+        try:
+            for sk in self._clients:
+                try:
+                    sk.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+        finally:
+            self._lock.release()
+        deadline = time.time() + timeout
+        while not self.queue.empty() and time.time() < deadline:
+            time.sleep(0.01)
+        self._stopping.set()
+        for thd in self._threads:
+            thd.join(max(0, deadline - time.time()))
+        self._threads = []
+
+    def stats(self):
+        """
+        Return a dictionary of counters: C{clients} connected so far,
+        C{received} frames, C{rejected} as corrupt, and C{forwarded},
+        C{spooled} or C{failed} results.
+        """
+        self._lock.acquire()
+        try:
+            return dict(self._stats)
+        finally:
+            self._lock.release()
+
+    def _count(self, name, n=1):
+        self._lock.acquire()
+        try:
+            self._stats[name] += n
+        finally:
+            self._lock.release()
+
+    def _handle(self, sk):
+        self._lock.acquire()
+        try:
+            self._stats['clients'] += 1
+            self._clients.add(sk)
+        finally:
+            self._lock.release()
+        try:
+            self._read_frames(sk)
+        finally:
+            self._lock.acquire()
+            try:
+                self._clients.discard(sk)
+            finally:
+                self._lock.release()
+
+    def _read_frames(self, sk):
+        size = self.codec.toserver_fmt_size
+        while 1:
+            toserver_pkt = _recv_exactly(sk, size)
+            if not toserver_pkt:
+                return
+            try:
+                self.codec._unpack_to_server(toserver_pkt)
+            except NSCAPacketError:
+                self._count('rejected')
+                return
+            self._count('received')
+            self.queue.put(toserver_pkt)
+
+    def _forward(self):
+        session = None
+        opened = 0
+        try:
+            while 1:
+                try:
+                    toserver_pkt = self.queue.get(timeout=0.1)
+                except queue.Empty:
+                    if self._stopping.is_set():
+                        return
+                    continue
+                try:
+                    if (session is not None and
+                            _clock() - opened > self.session_lifetime):
+                        session.close()
+                        session = None
+                    if session is None:
+                        session = self.notifier.session(self.timeout)
+                        opened = _clock()
+                        if self.notifier.spool is not None:
+                            self.notifier.spool.replay(session)
+                    if (session.timestamp -
+                            self.codec._packet_timestamp(toserver_pkt) >
+                            self.max_packet_age):
+                        toserver_pkt = self.codec._restamp(toserver_pkt,
+                                session.timestamp)
+                    session._send_packet(toserver_pkt)
+                    self._count('forwarded')
+                except _network_errors:
+                    if session is not None:
+                        session.close()
+                        session = None
+                    if self.notifier.spool is not None:
+                        self.notifier.spool._append_packet(toserver_pkt)
+                        self._count('spooled')
+                    else:
+                        self._count('failed')
+        finally:
+            if session is not None:
+                session.close()
+
+
+class RelayNotifier(object):
+    """
+    Class to send notifications through a local L{NSCARelay}, with the
+    same interface as L{NSCANotifier}.  The connection to the relay is
+    kept open, and reopened if it fails.
+    """
+
+    def __init__(self, socket_path, timeout=5):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.codec = NSCANotifier(None)
+        self._lock = threading.Lock()
+        self._sock = None
+
+    def host_result(self, host_name, return_code, plugin_output):
+        """
+        Send a passive host check; see L{NSCANotifier.host_result}.
+        """
+        self.svc_result(host_name, '', return_code, plugin_output)
+
+    def svc_result(self, host_name, svc_description, return_code,
+                   plugin_output, timeout=None):
+        """
+        Send a service result; see L{NSCANotifier.svc_result}.
+        """
+        self._send(self.codec._pack_to_server(int(time.time()), return_code,
+                host_name, svc_description, plugin_output))
+
+    def svc_results(self, results, timeout=None):
+        """
+        Send many results in a single write; see
+        L{NSCANotifier.svc_results}.
+
+        @returns: the number of results sent
+        """
+        timestamp = int(time.time())
+        packets = [self.codec._pack_to_server(timestamp, return_code,
+                        host_name, svc_description, plugin_output)
+                   for host_name, svc_description, return_code, plugin_output
+                   in results]
+        self._send(b''.join(packets))
+        return len(packets)
+
+    def close(self):
+        """
+        Close the connection to the relay.
+        """
+        self._lock.acquire()
+        try:
+            if self._sock is not None:
+                self._sock.close()
+                self._sock = None
+        finally:
+            self._lock.release()
+
+    def _send(self, data):
+        self._lock.acquire()
+        try:
+            for attempt in (1, 2):
+                if self._sock is None:
+                    sk = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                    sk.settimeout(self.timeout)
+                    try:
+                        sk.connect(self.socket_path)
+                    except:
+                        sk.close()
+                        raise
+                    self._sock = sk
+                try:
+                    self._sock.sendall(data)
+                    return
+                except socket.error:
+                    # the relay may have been restarted; reconnect once
+                    self._sock.close()
+                    self._sock = None
+                    if attempt == 2:
+                        raise
+        finally:
+            self._lock.release()
+
+
+class _Instrumentation(object):
+    """
+    Counters and timing hook for L{NSCANotifier.enable_instrumentation}.
+    """
+
+    def __init__(self, timing_hook):
+        self.timing_hook = timing_hook
+        self.lock = threading.Lock()
+        self.connections = self.sends = self.bytes = 0
+        self.timeouts = self.short_banners = 0
+        self.failures = {}
+
+    def connected(self):
+        self.lock.acquire()
+        try:
+            self.connections += 1
+        finally:
+            self.lock.release()
+
+    def packet_sent(self, phases, size):
+        self.lock.acquire()
+        try:
+            self.sends += 1
+            self.bytes += size
+        finally:
+            self.lock.release()
+        if self.timing_hook is not None:
+            self.timing_hook(phases)
+
+    def failed(self, error):
+        name = error.__class__.__name__
+        self.lock.acquire()
+        try:
+            self.failures[name] = self.failures.get(name, 0) + 1
+            if isinstance(error, socket.timeout):
+                self.timeouts += 1
+            elif isinstance(error, NSCAPacketError):
+                # the only packet error a sender sees is a short banner
+                self.short_banners += 1
+        finally:
+            self.lock.release()
+
+    def snapshot(self):
+        self.lock.acquire()
+        try:
+            return dict(connections=self.connections, sends=self.sends,
+                    bytes=self.bytes, timeouts=self.timeouts,
+                    short_banners=self.short_banners,
+                    failures=dict(self.failures))
+        finally:
+            self.lock.release()
+
+
+class _Rijndael256(object):
+    """
+    Rijndael with 256-bit blocks and keys (which is not AES: AES always has
+    128-bit blocks), in the 8-bit CFB mode that mcrypt calls
+    C{"rijndael-256"}/C{"cfb"}.  This is encryption_mode 16, used when
+    python-mcrypt is not installed.
+
+    The lookup tables are built once per process and the key schedule once
+    per instance.  CFB-8 needs one block encryption per byte, but only the
+    first byte of each block's output is used, so the final round computes
+    just that byte.
+    """
+
+    block_size = 32
+    key_size = 32
+    rounds = 14
+
+    _tables = None
+
+    def __init__(self, key):
+        if _Rijndael256._tables is None:
+            _Rijndael256._tables = self._make_tables()
+        sbox = self._tables[0]
+
+        # key expansion, with Nk = Nb = 8
+        w = list(struct.unpack('!8L', key))
+        rcon = 1
+        for i in range(8, 8 * (self.rounds + 1)):
+            t = w[i - 1]
+            if i % 8 == 0:
+                t = ((t << 8) & 0xffffffff) | (t >> 24)
+                t = self._sub_word(sbox, t) ^ (rcon << 24)
+                rcon = self._xtime(rcon)
+            elif i % 8 == 4:
+                t = self._sub_word(sbox, t)
+            w.append(w[i - 8] ^ t)
+        self.first_round_key = tuple(w[:8])
+        self.round_keys = [tuple(w[8 * r:8 * r + 8])
+                           for r in range(1, self.rounds)]
+        self.last_round_key_byte = w[8 * self.rounds] >> 24
+
+    @staticmethod
+    def _xtime(a):
+        a <<= 1
+        if a & 0x100:
+            a ^= 0x11b
+        return a
+
+    @staticmethod
+    def _sub_word(sbox, t):
+        return ((sbox[t >> 24] << 24) | (sbox[(t >> 16) & 255] << 16) |
+                (sbox[(t >> 8) & 255] << 8) | sbox[t & 255])
+
+    @classmethod
+    def _make_tables(cls):
+        # log/antilog tables over GF(2^8), with generator 3
+        exp, log = [0] * 255, [0] * 256
+        a = 1
+        for i in range(255):
+            exp[i], log[a] = a, i
+            a ^= cls._xtime(a)
+
+        sbox = [0] * 256
+        t0 = [0] * 256
+        for a in range(256):
+            b = a and exp[(255 - log[a]) % 255]
+            s = b
+            for i in range(4):
+                b = ((b << 1) | (b >> 7)) & 255
+                s ^= b
+            s ^= 0x63
+            sbox[a] = s
+            s2 = cls._xtime(s)
+            t0[a] = (s2 << 24) | (s << 16) | (s << 8) | (s2 ^ s)
+
+        def ror8(t):
+            return [(x >> 8) | ((x & 255) << 24) for x in t]
+        t1 = ror8(t0)
+        t2 = ror8(t1)
+        t3 = ror8(t2)
+        return sbox, t0, t1, t2, t3
+
+    def cfb8(self, iv, decrypt=False):
+        """
+        Return a function encrypting (or, with C{decrypt}, decrypting)
+        successive strings as one CFB-8 stream starting at C{iv}.
+        """
+        sbox, T0, T1, T2, T3 = self._tables
+        k0, k1, k2, k3, k4, k5, k6, k7 = self.first_round_key
+        round_keys = self.round_keys
+        last = self.last_round_key_byte
+        # the shift register, as eight big-endian words
+        register = list(struct.unpack('!8L', iv))
+
+        def encrypt(data):
+            r0, r1, r2, r3, r4, r5, r6, r7 = register
+            out = bytearray(data)
+            for n in range(len(out)):
+                s0, s1, s2, s3 = r0 ^ k0, r1 ^ k1, r2 ^ k2, r3 ^ k3
+                s4, s5, s6, s7 = r4 ^ k4, r5 ^ k5, r6 ^ k6, r7 ^ k7
+                # for 256-bit blocks, ShiftRows shifts rows 1-3 by 1, 3 and 4
+                for q0, q1, q2, q3, q4, q5, q6, q7 in round_keys:
+                    s0, s1, s2, s3, s4, s5, s6, s7 = (
+                        T0[s0 >> 24] ^ T1[(s1 >> 16) & 255] ^
+                            T2[(s3 >> 8) & 255] ^ T3[s4 & 255] ^ q0,
+                        T0[s1 >> 24] ^ T1[(s2 >> 16) & 255] ^
+                            T2[(s4 >> 8) & 255] ^ T3[s5 & 255] ^ q1,
+                        T0[s2 >> 24] ^ T1[(s3 >> 16) & 255] ^
+                            T2[(s5 >> 8) & 255] ^ T3[s6 & 255] ^ q2,
+                        T0[s3 >> 24] ^ T1[(s4 >> 16) & 255] ^
+                            T2[(s6 >> 8) & 255] ^ T3[s7 & 255] ^ q3,
+                        T0[s4 >> 24] ^ T1[(s5 >> 16) & 255] ^
+                            T2[(s7 >> 8) & 255] ^ T3[s0 & 255] ^ q4,
+                        T0[s5 >> 24] ^ T1[(s6 >> 16) & 255] ^
+                            T2[(s0 >> 8) & 255] ^ T3[s1 & 255] ^ q5,
+                        T0[s6 >> 24] ^ T1[(s7 >> 16) & 255] ^
+                            T2[(s1 >> 8) & 255] ^ T3[s2 & 255] ^ q6,
+                        T0[s7 >> 24] ^ T1[(s0 >> 16) & 255] ^
+                            T2[(s2 >> 8) & 255] ^ T3[s3 & 255] ^ q7)
+                c = out[n]
+                out[n] = c ^ sbox[s0 >> 24] ^ last
+                if not decrypt:
+                    c = out[n]
+                # shift the ciphertext byte into the register
+                r0 = ((r0 << 8) & 0xffffffff) | (r1 >> 24)
+                r1 = ((r1 << 8) & 0xffffffff) | (r2 >> 24)
+                r2 = ((r2 << 8) & 0xffffffff) | (r3 >> 24)
+                r3 = ((r3 << 8) & 0xffffffff) | (r4 >> 24)
+                r4 = ((r4 << 8) & 0xffffffff) | (r5 >> 24)
+                r5 = ((r5 << 8) & 0xffffffff) | (r6 >> 24)
+                r6 = ((r6 << 8) & 0xffffffff) | (r7 >> 24)
+                r7 = ((r7 << 8) & 0xffffffff) | c
+            register[:] = [r0, r1, r2, r3, r4, r5, r6, r7]
+            return bytes(out)
+        return encrypt
+
+
+class _SenderThread(threading.Thread):
+    """
+    Background thread that sends queued results for L{NSCANotifier}; see
+    L{NSCANotifier.start_queue}.
+    """
+
+    def __init__(self, notifier, maxsize, overflow, batch_size, timeout,
+                 exit_timeout, max_delay):
+        threading.Thread.__init__(self, name='pynsca-sender')
+        self.daemon = True
+        self.notifier = notifier
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.exit_timeout = exit_timeout
+
+        self.cond = threading.Condition()
+        self.queue = _Scheduler(max_delay)
+        self.in_flight = 0
+        self.stopping = False
+        self.sent = self.dropped = self.failed = 0
+        self.last_error = None
+
+    def put(self, result, priority=0):
+        self.cond.acquire()
+        try:
+            if self.stopping:
+                self.dropped += 1
+                return
+            if len(self.queue) >= self.maxsize:
+                if self.overflow == DROP_NEWEST:
+                    self.dropped += 1
+                    return
+                elif self.overflow == DROP_OLDEST:
+                    self.queue.drop()
+                    self.dropped += 1
+                else:
+                    while len(self.queue) >= self.maxsize and not self.stopping:
+                        self.cond.wait()
+                    if self.stopping:
+                        self.dropped += 1
+                        return
+            self.queue.append(result, priority)
+            self.cond.notify_all()
+        finally:
+            self.cond.release()
+
+    def run(self):
+        _running_senders.add(self)
+        try:
+            while 1:
+                self.cond.acquire()
+                try:
+                    while not self.queue and not self.stopping:
+                        self.cond.wait()
+                    if not self.queue:
+                        return
+                    batch = []
+                    while self.queue and len(batch) < self.batch_size:
+                        batch.extend(self.queue.pop())
+                    self.in_flight = len(batch)
+                    self.cond.notify_all()
+                finally:
+                    self.cond.release()
+
+                sent, error = self.send(batch)
+
+                self.cond.acquire()
+                try:
+                    self.in_flight = 0
+                    self.sent += sent
+                    self.failed += len(batch) - sent
+                    if error is not None:
+                        self.last_error = error
+                    self.cond.notify_all()
+                finally:
+                    self.cond.release()
+        finally:
+            _running_senders.discard(self)
+
+    def send(self, batch):
+        try:
+            return self.notifier.svc_results(batch, self.timeout), None
+        except NSCASendError as e:
+            return e.sent, e.error
+
+    def flush(self, timeout=None):
+        self.cond.acquire()
+        try:
+            return self._wait_idle(timeout)
+        finally:
+            self.cond.release()
+
+    def stop(self, timeout=None):
+        self.cond.acquire()
+        try:
+            drained = self._wait_idle(timeout)
+            self.stopping = True
+            self.dropped += len(self.queue)
+            self.queue.clear()
+            self.cond.notify_all()
+        finally:
+            self.cond.release()
+        return drained
+
+    def stats(self):
+        self.cond.acquire()
+        try:
+            return dict(queued=len(self.queue) + self.in_flight,
+                    sent=self.sent, dropped=self.dropped, failed=self.failed,
+                    overdue=self.queue.overdue)
+        finally:
+            self.cond.release()
+
+    def _wait_idle(self, timeout):
+        # call with self.cond held
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while self.queue or self.in_flight:
+            if timeout is None:
+                self.cond.wait()
+            else:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.cond.wait(remaining)
+        return True
+
+
+class NSCAReceiver(object):
+    """
+    A stand-in for the C{nsca} daemon, for load testing senders and for
+    building relays.
+
+    Each connection gets its own random IV and the current timestamp in its
+    banner, and may carry any number of packets.  Every packet is decrypted
+    and checked (protocol version, CRC and age) and then handed on as a
+    L{CheckResult}: to C{callback} if one is given (from the connection's
+    thread, so it must be thread-safe), and otherwise to the C{results}
+    queue.  As with the real daemon, a bad packet ends its connection.
+
+    @ivar port: the port being listened on, useful when binding to port 0
+    @ivar results: queue of received results, if there is no callback
+    """
+
+    def __init__(self, host='', port=5667, encryption_mode=1, password=None,
+                 callback=None, max_packet_age=30):
+        """
+        @param encryption_mode: as for L{NSCANotifier}
+        @param password: as for L{NSCANotifier}
+        @param callback: called with each L{CheckResult}
+        @param max_packet_age: reject packets whose timestamp is more than
+            this many seconds from the current time, or None to accept any
+        """
+        self.codec = NSCANotifier(host, port, encryption_mode, password)
+        self.callback = callback
+        self.max_packet_age = max_packet_age
+        if callback is None:
+            self.results = queue.Queue()
+        else:
+            self.results = None
+
+        self._lock = threading.Lock()
+        self._stats = dict(connections=0, packets=0, rejected=0)
+
+        self.server = _ReceiverServer((host, port), _ReceiverHandler)
+        self.server.receiver = self
+        self.port = self.server.server_address[1]
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        """
+        Start serving, from a background thread.
+        """
+        self._thread = threading.Thread(target=self.server.serve_forever,
+                args=(0.1,), name='pynsca-receiver')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop accepting connections and close the listening socket.
+        """
+        if self._thread is not None:
+            self.server.shutdown()
+            self._thread.join()
+            self._thread = None
+        self.server.server_close()
+
+    def stats(self):
+        """
+        Return a dictionary of counters: C{connections} accepted, C{packets}
+        received and C{rejected} as corrupt or too old.
+        """
+        self._lock.acquire()
+        try:
+            return dict(self._stats)
+        finally:
+            self._lock.release()
+
+    def _count(self, name):
+        self._lock.acquire()
+        try:
+            self._stats[name] += 1
+        finally:
+            self._lock.release()
+
+    def _handle(self, sk):
+        codec = self.codec
+        self._count('connections')
+        iv = os.urandom(128)
+        timestamp = int(time.time())
+        sk.sendall(struct.pack(codec.fromserver_fmt, iv, timestamp))
+        decrypt = codec._encryptor(iv, codec.encryption_mode,
+                codec.password, decrypt=True)
+        while 1:
+            toserver_pkt = _recv_exactly(sk, codec.toserver_fmt_size)
+            if not toserver_pkt:
+                return
+            try:
+                result = codec._unpack_to_server(decrypt(toserver_pkt))
+                if (self.max_packet_age is not None and
+                        abs(result.timestamp - time.time()) > self.max_packet_age):
+                    raise NSCAPacketError("stale packet")
+            except NSCAPacketError:
+                self._count('rejected')
+                return
+            self._count('packets')
+            if self.callback is not None:
+                self.callback(result)
+            else:
+                self.results.put(result)
+
+
+class _ReceiverServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class _ReceiverHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        try:
+            self.server.receiver._handle(self.request)
+        except socket.error:
+            pass
+
+
+if hasattr(socketserver, 'ThreadingUnixStreamServer'):
+    class _RelayServer(socketserver.ThreadingUnixStreamServer):
+        daemon_threads = True
+        request_queue_size = 128
+
+
+class _RelayHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        try:
+            self.server.relay._handle(self.request)
+        except socket.error:
+            pass
+
+
+def relay_main(argv=None):
+    """
+    Command-line entry point for L{NSCARelay}, installed as
+    C{pynsca-relay}.
+    """
+    import argparse
+    parser = argparse.ArgumentParser(
+            description='Relay NSCA results from a local Unix socket to '
+                        'an NSCA server.')
+    parser.add_argument('-s', '--socket', required=True,
+            help='path of the Unix socket to listen on')
+    parser.add_argument('-H', '--host', required=True,
+            help='NSCA server to forward to, or a comma-separated list of '
+                 'servers to fail over between')
+    parser.add_argument('-p', '--port', type=int, default=5667,
+            help='NSCA server port (default 5667)')
+    _add_encryption_arguments(parser)
+    parser.add_argument('-n', '--connections', type=int, default=2,
+            help='number of upstream connections (default 2)')
+    parser.add_argument('--spool', default=None,
+            help='spool file for results that cannot be forwarded')
+    args = parser.parse_args(argv)
+
+    spool = None
+    if args.spool:
+        spool = NSCASpool(args.spool)
+    encryption_mode, password = _encryption_settings(args)
+    notifier = NSCANotifier(_servers_argument(args.host), args.port,
+            encryption_mode, password, spool=spool)
+    relay = NSCARelay(args.socket, notifier, connections=args.connections)
+    try:
+        relay.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+def main(argv=None, stdin=None, stdout=None, stderr=None):
+    """
+    Command-line entry point, installed as C{pynsca}: a streaming
+    replacement for C{send_nsca}.
+
+    Results are read from standard input, one per line, in C{send_nsca}'s
+    format: C{host<tab>service<tab>return code<tab>output} for service
+    checks, and C{host<tab>return code<tab>output} for host checks.  They
+    are sent as they arrive, over a connection that is kept open and
+    replaced every C{--session-lifetime} seconds, so that the server's
+    timestamp in the packets stays fresh.  Lines that cannot be parsed are
+    reported and skipped.
+
+    @returns: the exit status: 0 on success, 2 if sending failed
+    """
+    import argparse
+    stdin = stdin or sys.stdin
+    stdout = stdout or sys.stdout
+    stderr = stderr or sys.stderr
+    parser = argparse.ArgumentParser(
+            description='Send check results read from standard input to an '
+                        'NSCA server, like send_nsca.')
+    parser.add_argument('-H', '--host', required=True,
+            help='NSCA server, or a comma-separated list of servers to fail '
+                 'over between')
+    parser.add_argument('-p', '--port', type=int, default=5667,
+            help='NSCA server port (default 5667)')
+    parser.add_argument('-to', '--timeout', type=float, default=10,
+            help='connection timeout in seconds (default 10)')
+    parser.add_argument('-d', '--delimiter', default='\t',
+            help='field delimiter (default tab)')
+    _add_encryption_arguments(parser)
+    parser.add_argument('--session-lifetime', type=float, default=15,
+            help='seconds before a connection is replaced (default 15); '
+                 'keep this below the server\'s max_packet_age')
+    args = parser.parse_args(argv)
+
+    encryption_mode, password = _encryption_settings(args)
+    notifier = NSCANotifier(_servers_argument(args.host), args.port,
+            encryption_mode, password)
+    delimiter = args.delimiter
+    session = None
+    opened = 0
+    sent = 0
+    try:
+        try:
+            for line in iter(stdin.readline, ''):
+                line = line.rstrip('\r\n')
+                if not line:
+                    continue
+                fields = line.split(delimiter, 3)
+                try:
+                    if len(fields) == 4:
+                        result = (fields[0], fields[1], int(fields[2]),
+                                fields[3])
+                    elif len(fields) == 3:
+                        fields = line.split(delimiter, 2)
+                        result = (fields[0], '', int(fields[1]), fields[2])
+                    else:
+                        raise ValueError("wrong number of fields")
+                    # the packet's return code field is 16 bits
+                    if not 0 <= result[2] <= 65535:
+                        raise ValueError("return code out of range")
+                except ValueError:
+                    stderr.write("Skipping invalid input: %r\n" % (line,))
+                    continue
+
+                if session is not None and \
+                        _clock() - opened > args.session_lifetime:
+                    session.close()
+                    session = None
+                if session is None:
+                    session = notifier.session(args.timeout)
+                    opened = _clock()
+                session.svc_result(*result)
+                sent += 1
+        except _network_errors as e:
+            stderr.write("Error: could not send to %s: %s\n" % (args.host, e))
+            return 2
+    finally:
+        if session is not None:
+            session.close()
+        stdout.write("%d data packet(s) sent to host successfully.\n" % sent)
+    return 0
+
+
+def _add_encryption_arguments(parser):
+    parser.add_argument('-c', '--config',
+            help='send_nsca.cfg-style file with password and '
+                 'encryption_method settings')
+    parser.add_argument('-e', '--encryption-mode', type=int, default=None,
+            help='encryption mode (default 1, or from the config file)')
+    parser.add_argument('--password', default=None,
+            help='encryption password (default from the config file)')
+
+
+def _servers_argument(host):
+    # a comma-separated -H argument becomes a list of servers
+    if ',' in host:
+        return host.split(',')
+    return host
+
+
+def _encryption_settings(args):
+    """
+    Return C{(encryption_mode, password)} from command-line arguments added
+    by L{_add_encryption_arguments}, falling back to the config file.
+    """
+    config = {}
+    if args.config:
+        config = _read_send_nsca_config(args.config)
+    encryption_mode = args.encryption_mode
+    if encryption_mode is None:
+        encryption_mode = int(config.get('encryption_method', 1))
+    password = args.password
+    if password is None:
+        password = config.get('password')
+    return encryption_mode, password
+
+
+def _read_send_nsca_config(path):
+    """
+    Read C{name=value} settings from a send_nsca.cfg file.
+    """
+    config = {}
+    f = open(path)
+    try:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#') or '=' not in line:
+                continue
+            name, value = line.split('=', 1)
+            config[name.strip()] = value.strip()
+    finally:
+        f.close()
+    return config
+
+
+class _ServerHealth(object):
+    """
+    Health of one of the servers of an L{NSCANotifier}, with a circuit
+    breaker: after C{failure_threshold} consecutive failures the server is
+    skipped for C{retry_interval} seconds, after which one connection is let
+    through as a probe.
+    """
+
+    # weight of the newest sample in the latency moving average
+    latency_weight = 0.2
+
+    def __init__(self, address, failure_threshold, retry_interval):
+        self.address = tuple(address)
+        self.failure_threshold = failure_threshold
+        self.retry_interval = retry_interval
+        self.lock = threading.Lock()
+        self.consecutive_failures = 0
+        self.last_error = None
+        self.latency = None
+        self.retry_at = None
+        self.probing = False
+
+    def available(self, now):
+        """
+        Return True if the server should be tried.  If the server is due a
+        probe, only the first caller gets True until the probe finishes.
+        """
+        self.lock.acquire()
+        try:
+            if self.consecutive_failures < self.failure_threshold:
+                return True
+            if self.probing or now < self.retry_at:
+                return False
+            self.probing = True
+            return True
+        finally:
+            self.lock.release()
+
+    def succeeded(self, latency):
+        self.lock.acquire()
+        try:
+            self.consecutive_failures = 0
+            self.probing = False
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency += self.latency_weight * (latency - self.latency)
+        finally:
+            self.lock.release()
+
+    def failed(self, error):
+        self.lock.acquire()
+        try:
+            self.consecutive_failures += 1
+            self.last_error = error
+            self.probing = False
+            if self.consecutive_failures >= self.failure_threshold:
+                self.retry_at = _clock() + self.retry_interval
+        finally:
+            self.lock.release()
+
+    def snapshot(self):
+        self.lock.acquire()
+        try:
+            if self.consecutive_failures < self.failure_threshold:
+                state = 'closed'
+            elif self.probing or _clock() >= self.retry_at:
+                state = 'half-open'
+            else:
+                state = 'open'
+            return dict(address=self.address, state=state,
+                    consecutive_failures=self.consecutive_failures,
+                    last_error=self.last_error, latency=self.latency)
+        finally:
+            self.lock.release()
+
+
+class _SessionPool(threading.Thread):
+    """
+    Background thread keeping connections ready for L{NSCANotifier}; see
+    L{NSCANotifier.start_pool}.
+    """
+
+    def __init__(self, notifier, size, max_age, idle_timeout, timeout):
+        threading.Thread.__init__(self, name='pynsca-pool')
+        self.daemon = True
+        self.notifier = notifier
+        self.size = size
+        self.max_age = max_age
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        # check for stale connections several times per lifetime
+        self.interval = min(max_age, idle_timeout) / 4.0
+
+        self.cond = threading.Condition()
+        self.ready = collections.deque()
+        # sessions handed out by get() and not yet returned
+        self.lent = set()
+        self.stopping = False
+        self.hits = self.misses = self.replaced = self.failures = 0
+
+    def get(self):
+        """
+        Return a ready session, or None if there is none.
+        """
+        self.cond.acquire()
+        try:
+            now = _clock()
+            while self.ready:
+                session = self.ready.pop()
+                if not self._stale(session, now):
+                    self.hits += 1
+                    self.lent.add(session)
+                    # its connect and banner phases are not part of this send
+                    session._phases = None
+                    return session
+                self.replaced += 1
+                session.close()
+            self.misses += 1
+            self.cond.notify_all()
+            return None
+        finally:
+            self.cond.release()
+
+    def put(self, session, reusable=True):
+        session._last_used = _clock()
+        self.cond.acquire()
+        try:
+            self.lent.discard(session)
+            if (not reusable or self.stopping or
+                    len(self.ready) + len(self.lent) >= self.size):
+                session.close()
+            else:
+                self.ready.append(session)
+            self.cond.notify_all()
+        finally:
+            self.cond.release()
+
+    def run(self):
+        while 1:
+            self.cond.acquire()
+            try:
+                self._expire()
+                while (len(self.ready) + len(self.lent) >= self.size and
+                        not self.stopping):
+                    self.cond.wait(self.interval)
+                    self._expire()
+                if self.stopping:
+                    return
+            finally:
+                self.cond.release()
+
+            try:
+                session = self.notifier.session(self.timeout)
+            except _network_errors:
+                self.cond.acquire()
+                try:
+                    self.failures += 1
+                    # try again later, rather than hammering a dead server
+                    if not self.stopping:
+                        self.cond.wait(self.interval)
+                finally:
+                    self.cond.release()
+                continue
+            self.put(session)
+
+    def stop(self):
+        self.cond.acquire()
+        try:
+            self.stopping = True
+            while self.ready:
+                self.ready.pop().close()
+            self.cond.notify_all()
+        finally:
+            self.cond.release()
+
+    def stats(self):
+        self.cond.acquire()
+        try:
+            return dict(size=self.size, ready=len(self.ready), hits=self.hits,
+                    misses=self.misses, replaced=self.replaced,
+                    failures=self.failures)
+        finally:
+            self.cond.release()
+
+    def _stale(self, session, now):
+        return (now - session._opened > self.max_age or
+                now - session._last_used > self.idle_timeout or
+                self._closed(session))
+
+    def _closed(self, session):
+        # the server never sends anything after its banner, so a readable
+        # socket means it has closed the connection (or is misbehaving)
+        try:
+            return bool(select.select([session.sock], [], [], 0)[0])
+        except (select.error, ValueError, socket.error):
+            return True
+
+    def _expire(self):
+        # call with self.cond held
+        now = _clock()
+        for session in [s for s in self.ready if self._stale(s, now)]:
+            self.ready.remove(session)
+            session.close()
+            self.replaced += 1
+
+
+class _ResolverCache(object):
+    """
+    Cache of C{getaddrinfo} results for L{NSCANotifier}, so that sending a
+    result does not wait for name resolution every time.
+
+    Addresses are kept for C{ttl} seconds.  If they cannot be looked up
+    again after that, the old addresses are kept for another
+    C{negative_ttl} seconds; a lookup that fails with nothing to fall back
+    on is cached, and its error raised again, for C{negative_ttl} seconds.
+    """
+
+    def __init__(self, ttl, negative_ttl):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.lock = threading.Lock()
+        # (host, port) -> (expiry, addrinfos or None, error or None)
+        self.entries = {}
+
+    def resolve(self, host, port):
+        """
+        Return C{getaddrinfo} results for a TCP connection to C{host} and
+        C{port}, with address families interleaved as for happy eyeballs
+        (RFC 8305), or raise C{socket.gaierror}.
+        """
+        key = (host, port)
+        now = _clock()
+        entry = self.entries.get(key)
+        if entry is not None and now < entry[0]:
+            if entry[2] is not None:
+                raise entry[2]
+            return entry[1]
+
+        # several threads may look up the same name at once; that is
+        # harmless, so the lookup is done without the lock held
+        try:
+            addrinfos = _interleave_families(socket.getaddrinfo(host, port,
+                    socket.AF_UNSPEC, socket.SOCK_STREAM))
+            if not addrinfos:
+                raise socket.gaierror("no addresses for %s" % (host,))
+        except socket.error as e:
+            self.lock.acquire()
+            try:
+                entry = self.entries.get(key)
+                if entry is not None and entry[1] is not None:
+                    # keep using the addresses we had
+                    self.entries[key] = (now + self.negative_ttl, entry[1],
+                            None)
+                    return entry[1]
+                self.entries[key] = (now + self.negative_ttl, None, e)
+            finally:
+                self.lock.release()
+            raise
+        self.lock.acquire()
+        try:
+            self.entries[key] = (now + self.ttl, addrinfos, None)
+        finally:
+            self.lock.release()
+        return addrinfos
+
+
+def _interleave_families(addrinfos):
+    # alternate between address families, starting with the family of the
+    # first address
+    by_family = collections.OrderedDict()
+    for addrinfo in addrinfos:
+        by_family.setdefault(addrinfo[0], []).append(addrinfo)
+    interleaved = []
+    queues = list(by_family.values())
+    while queues:
+        for addrinfos in queues:
+            interleaved.append(addrinfos.pop(0))
+        queues = [addrinfos for addrinfos in queues if addrinfos]
+    return interleaved
+
+
+def _happy_eyeballs(addrinfos, timeout, delay):
+    """
+    Connect to the first of C{addrinfos} that answers, starting a new
+    attempt every C{delay} seconds (or as soon as one fails) while earlier
+    attempts are still pending, and return the connected socket.
+    """
+    pending = list(addrinfos)
+    attempts = []
+    error = None
+    deadline = None
+    if timeout is not None:
+        deadline = _clock() + timeout
+    next_attempt = 0
+    try:
+        while pending or attempts:
+            now = _clock()
+            if pending and (now >= next_attempt or not attempts):
+                family, socktype, proto, canonname, sockaddr = pending.pop(0)
+                sk = None
+                try:
+                    # e.g. an IPv6 address on a host without IPv6
+                    sk = socket.socket(family, socktype, proto)
+                    sk.setblocking(0)
+                    err = sk.connect_ex(sockaddr)
+                except socket.error as e:
+                    if sk is not None:
+                        sk.close()
+                    error = e
+                    continue
+                if err == 0:
+                    sk.settimeout(timeout)
+                    return sk
+                if err not in (errno.EINPROGRESS, errno.EWOULDBLOCK,
+                        errno.EALREADY, getattr(errno, 'WSAEWOULDBLOCK', -1)):
+                    sk.close()
+                    error = socket.error(err, os.strerror(err))
+                    continue
+                attempts.append(sk)
+                next_attempt = now + delay
+                continue
+            if deadline is not None and now >= deadline:
                 break
-            buf += data
 
-        # make up reply
-        iv, timestamp = self._decode_from_server(buf)
-        toserver_pkt = self._encode_to_server(iv, timestamp, return_code,
-                host_name, svc_description, plugin_output,
-                self.encryption_mode, self.password)
+            waits = []
+            if pending:
+                waits.append(next_attempt - now)
+            if deadline is not None:
+                waits.append(deadline - now)
+            wait = None
+            if waits:
+                wait = max(min(waits), 0)
+            _, writable, failed = select.select([], attempts, attempts, wait)
+            for sk in set(writable + failed):
+                err = sk.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if err == 0:
+                    attempts.remove(sk)
+                    sk.settimeout(timeout)
+                    return sk
+                attempts.remove(sk)
+                sk.close()
+                error = socket.error(err, os.strerror(err))
+                # don't wait for the delay to try the next address
+                next_attempt = now
+    finally:
+        for sk in attempts:
+            sk.close()
+    if error is None:
+        error = socket.timeout("timed out")
+    raise error
+
+
+class _Scheduler(object):
+    """
+    The queue of a L{_SenderThread}, handing out the most urgent results
+    first; see L{NSCANotifier.start_queue}.
+
+    Each (host, service) pair has at most one entry queued, holding all of
+    its pending results in order; the entry takes the urgency of its most
+    urgent result.  Entries are filed by urgency, then by host, and hosts
+    of the same urgency take turns.  Entries that move to a more urgent
+    level, or are taken because they are overdue, are left behind in the
+    structures they were filed in, and skipped when found; once those
+    structures hold more left-behind entries than queued results, they are
+    compacted.
+    """
+
+    # how urgent each return code is; other codes are treated as UNKNOWN
+    severities = {OK: 0, WARNING: 1, UNKNOWN: 2, CRITICAL: 3}
+
+    def __init__(self, max_delay):
+        self.max_delay = max_delay
+        # (priority, severity) -> (OrderedDict of host -> deque of entries,
+        # deque of entries in arrival order)
+        self.levels = {}
+        # (host_name, svc_description) -> queued entry
+        self.pending = {}
+        # all entries, in arrival order, if max_delay is set
+        self.arrivals = collections.deque()
+        self.count = 0
+        self.overdue = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, result, priority=0):
+        level = (priority, self.severities.get(result[2], 2))
+        key = (result[0], result[1])
+        entry = self.pending.get(key)
+        if entry is None:
+            entry = self.pending[key] = _ScheduledEntry(key, _clock())
+            if self.max_delay is not None:
+                self.arrivals.append(entry)
+                if self._bloated(self.arrivals):
+                    live = [e for e in self.arrivals if not e.taken]
+                    self.arrivals.clear()
+                    self.arrivals.extend(live)
+            self._file(entry, level)
+        elif level > entry.level:
+            self._file(entry, level)
+        entry.results.append(result)
+        self.count += 1
+
+    def pop(self):
+        """
+        Remove the most urgent entry, and return its results.
+        """
+        entry = self._overdue_entry()
+        if entry is None:
+            entry = self._most_urgent_entry()
+        else:
+            self.overdue += len(entry.results)
+        self._take(entry)
+        return entry.results
+
+    def drop(self):
+        """
+        Discard the oldest of the least urgent results.
+        """
+        while self.levels:
+            level = min(self.levels)
+            arrivals = self.levels[level][1]
+            while arrivals and not self._filed(arrivals[0], level):
+                arrivals.popleft()
+            if not arrivals:
+                del self.levels[level]
+                continue
+            entry = arrivals[0]
+            entry.results.pop(0)
+            self.count -= 1
+            if not entry.results:
+                self._take(entry)
+            return
+        raise IndexError("drop from an empty queue")
+
+    def clear(self):
+        self.levels.clear()
+        self.pending.clear()
+        self.arrivals.clear()
+        self.count = 0
+
+    def _file(self, entry, level):
+        entry.level = level
+        hosts, arrivals = self.levels.setdefault(level,
+                (collections.OrderedDict(), collections.deque()))
+        hosts.setdefault(entry.key[0], collections.deque()).append(entry)
+        arrivals.append(entry)
+        if self._bloated(arrivals):
+            self._compact(level)
+
+    def _bloated(self, entries):
+        # every live entry holds at least one result
+        return len(entries) > 2 * self.count + 32
+
+    def _compact(self, level):
+        hosts, arrivals = self.levels[level]
+        for host in list(hosts):
+            entries = [e for e in hosts[host] if self._filed(e, level)]
+            if entries:
+                hosts[host] = collections.deque(entries)
+            else:
+                del hosts[host]
+        live = [e for e in arrivals if self._filed(e, level)]
+        arrivals.clear()
+        arrivals.extend(live)
+
+    def _filed(self, entry, level):
+        return not entry.taken and entry.level == level
+
+    def _take(self, entry):
+        entry.taken = True
+        del self.pending[entry.key]
+        self.count -= len(entry.results)
+
+    def _overdue_entry(self):
+        if self.max_delay is None:
+            return None
+        arrivals = self.arrivals
+        while arrivals and arrivals[0].taken:
+            arrivals.popleft()
+        if arrivals and _clock() - arrivals[0].queued >= self.max_delay:
+            return arrivals[0]
+        return None
+
+    def _most_urgent_entry(self):
+        while self.levels:
+            level = max(self.levels)
+            hosts, arrivals = self.levels[level]
+            while arrivals and not self._filed(arrivals[0], level):
+                arrivals.popleft()
+            while hosts:
+                host = next(iter(hosts))
+                entries = hosts.pop(host)
+                while entries and not self._filed(entries[0], level):
+                    entries.popleft()
+                if entries:
+                    entry = entries.popleft()
+                    if entries:
+                        # this host goes to the back of the line
+                        hosts[host] = entries
+                    return entry
+            del self.levels[level]
+        raise IndexError("pop from an empty queue")
+
+
+class _ScheduledEntry(object):
+
+    __slots__ = ('key', 'queued', 'level', 'results', 'taken')
+
+    def __init__(self, key, queued):
+        self.key = key
+        self.queued = queued
+        self.level = None
+        self.results = []
+        self.taken = False
+
+
+def _recv_exactly(sk, size):
+    """
+    Read C{size} bytes from C{sk}, or fewer if the connection is closed.
+    """
+    buf = b''
+    while len(buf) < size:
+        data = sk.recv(size - len(buf))
+        if not data:
+            break
+        buf += data
+    return buf
+
+
+_running_senders = set()
+
+def _stop_senders():
+    for sender in list(_running_senders):
+        sender.stop(sender.exit_timeout)
 
-        # and send it
-        sk.sendall(toserver_pkt)
-        sk.close()
+atexit.register(_stop_senders)
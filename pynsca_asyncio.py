@@ -0,0 +1,149 @@
+# The contents of this file are subject to the Mozilla Public License
+# Version 1.1 (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS"
+# basis, WITHOUT WARRANTY OF ANY KIND, either express or implied. See the
+# License for the specific language governing rights and limitations
+# under the License.
+#
+# The Original Code is pynsca.
+#
+# The Initial Developer of the Original Code is Dustin J. Mitchell.  Portions
+# created by Dustin J. Mitchell are Copyright (C) Mozilla, Inc. All Rights
+# Reserved.
+#
+# Alternatively, the contents of this file may be used under the terms of the
+# GNU Public License, Version 2 (the  "GPLv2 License"), in which case the
+# provisions of GPLv2 License are applicable instead of those above. If you
+# wish to allow use of your version of this file only under the terms of the
+# GPLv2 License and not to allow others to use your version of this file under
+# the MPL, indicate your decision by deleting the provisions above and replace
+# them with the notice and other provisions required by the GPLv2 License. If
+# you do not delete the provisions above, a recipient may use your version of
+# this file under either the MPL or the GPLv2 License.
+
+"""
+asyncio support for pynsca.  This module requires Python 3.5 or higher.
+"""
+
+import asyncio
+
+import pynsca
+
+
+class AsyncNSCANotifier(object):
+    """
+    Class to send notifications to a Nagios server via NSCA, from asyncio
+    code.
+
+    Packets are built exactly as L{pynsca.NSCANotifier} builds them; only
+    the network I/O differs.  At most C{concurrency} connections are open
+    at once, and further submissions wait for a free slot.  Every call takes
+    an optional C{timeout}, a deadline in seconds for the whole call,
+    including the wait for a slot.
+    """
+
+    def __init__(self, monitoring_server, monitoring_port=5667,
+                 encryption_mode=1, password=None, concurrency=64, timeout=5):
+        self.notifier = pynsca.NSCANotifier(monitoring_server,
+                monitoring_port, encryption_mode, password)
+        self.concurrency = concurrency
+        self.timeout = timeout
+        # created on first use, so that it belongs to the running loop
+        self._semaphore = None
+
+    async def host_result(self, host_name, return_code, plugin_output,
+                          timeout=None):
+        """
+        Send a passive host check; see L{pynsca.NSCANotifier.host_result}.
+        """
+        await self.svc_result(host_name, '', return_code, plugin_output,
+                timeout)
+
+    async def svc_result(self, host_name, svc_description, return_code,
+                         plugin_output, timeout=None):
+        """
+        Send a service result; see L{pynsca.NSCANotifier.svc_result}.
+        """
+        session = _Session(self)
+        await self._deadline(session,
+            [(host_name, svc_description, return_code, plugin_output)],
+            timeout)
+
+    async def svc_results(self, results, timeout=None):
+        """
+        Send many results over a single connection; see
+        L{pynsca.NSCANotifier.svc_results}.
+
+        @returns: the number of packets sent
+        @raises pynsca.NSCASendError: if anything fails, including the
+            deadline passing
+        """
+        session = _Session(self)
+        try:
+            await self._deadline(session, results, timeout)
+        except Exception as e:
+            raise pynsca.NSCASendError(session.sent, e)
+        return session.sent
+
+    async def submit_all(self, results, timeout=None):
+        """
+        Send each result over its own connection, concurrently, subject to
+        the notifier's concurrency limit.  Each result has its own deadline.
+
+        @param results: iterable of C{(host_name, svc_description,
+            return_code, plugin_output)} tuples
+        @returns: a list with, for each result in order, C{None} on success
+            or the exception that caused it to fail
+        """
+        return await asyncio.gather(
+            *[self.svc_result(*result, timeout=timeout) for result in results],
+            return_exceptions=True)
+
+    async def _deadline(self, session, results, timeout):
+        if timeout is None:
+            timeout = self.timeout
+        return await asyncio.wait_for(self._limited(session, results),
+                timeout)
+
+    async def _limited(self, session, results):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        # the send is only started once there is a slot for it, so that a
+        # deadline passing while waiting leaves no coroutine behind
+        async with self._semaphore:
+            return await session.send(results)
+
+
+class _Session(object):
+    """
+    One connection's worth of packets, counting those sent so that the
+    count survives cancellation.
+    """
+
+    def __init__(self, async_notifier):
+        self.notifier = async_notifier.notifier
+        self.sent = 0
+
+    async def send(self, results):
+        n = self.notifier
+        reader, writer = await asyncio.open_connection(n.monitoring_server,
+                n.monitoring_port)
+        try:
+            iv, timestamp = n._decode_from_server(
+                    await reader.readexactly(n.fromserver_fmt_size))
+            encrypt = n._encryptor(iv, n.encryption_mode, n.password)
+            for host_name, svc_description, return_code, plugin_output in results:
+                writer.write(encrypt(n._pack_to_server(timestamp, return_code,
+                        host_name, svc_description, plugin_output)))
+                await writer.drain()
+                self.sent += 1
+        finally:
+            writer.close()
+            if hasattr(writer, 'wait_closed'):
+                try:
+                    await writer.wait_closed()
+                except OSError:
+                    pass
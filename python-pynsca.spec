@@ -1,5 +1,6 @@
 %{!?python_sitelib: %define python_sitelib %(%{__python} -c "from distutils.sysconfig import get_python_lib; print get_python_lib()")}
 %{!?pyver: %define pyver %(%{__python} -c "import sys ; print sys.version[:3]")}
+%{!?with_asyncio: %define with_asyncio %(%{__python} -c "import sys ; print(int(sys.version_info >= (3, 5)))")}
 
 %global real_name pynsca
 
@@ -40,6 +41,11 @@ rm -rf %{buildroot}
 %defattr(-,root,root,-)
 %doc README.rst
 %attr(0755,root,root) %{python_sitelib}/%{real_name}.py*
+%{python_sitelib}/%{real_name}_numpy.py*
+%if %{with_asyncio}
+%{python_sitelib}/%{real_name}_asyncio.py*
+%endif
+%{_bindir}/%{real_name}*
 %{python_sitelib}/%{real_name}-%{version}-py%{pyver}.egg-info/
 
 %dir
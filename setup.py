@@ -26,10 +26,15 @@
 # this file under either the MPL or the GPLv2 License.
 
 import os
+import sys
 from setuptools import setup, find_packages
 
 descr = open(os.path.join(os.path.dirname(__file__), 'README.rst')).read()
 
+py_modules = ['pynsca', 'pynsca_numpy']
+if sys.version_info >= (3, 5):
+    py_modules.append('pynsca_asyncio')
+
 setup(
     name='pynsca',
     version='1.6a',
@@ -40,19 +45,27 @@ setup(
     url='http://github.com/djmitche/pynsca',
     license='MPL-1.1',
     packages=find_packages(),
-    py_modules=['pynsca'],
+    py_modules=py_modules,
     include_package_data=True,
     zip_safe=False,
+    extras_require={
+        'numpy': ['numpy'],
+    },
+    entry_points={
+        'console_scripts': [
+            'pynsca = pynsca:main',
+            'pynsca-relay = pynsca:relay_main',
+        ],
+    },
     classifiers=[
         'Development Status :: 5 - Production/Stable',
         'Intended Audience :: System Administrators',
         'License :: OSI Approved :: Mozilla Public License 1.1 (MPL 1.1)',
         'Operating System :: OS Independent',
         'Programming Language :: Python',
-        'Programming Language :: Python :: 2.4',
-        'Programming Language :: Python :: 2.5',
-        'Programming Language :: Python :: 2.6',
+        'Programming Language :: Python :: 2',
         'Programming Language :: Python :: 2.7',
+        'Programming Language :: Python :: 3',
         'Programming Language :: Python :: Implementation :: CPython',
         'Topic :: System :: Monitoring',
         'Topic :: System :: Networking :: Monitoring',
@@ -27,15 +27,37 @@
 # you do not delete the provisions above, a recipient may use your version of
 # this file under either the MPL or the GPLv2 License.
 
+import errno
+import os
+import shutil
+import tempfile
 import threading
+import time
 import socket
 import unittest
 import base64
-import pynsca
+import binascii
+import struct
 try:
-    import mcrypt
+    from StringIO import StringIO
 except ImportError:
-    mcrypt = None
+    from io import StringIO
+import pynsca
+
+def start_receiver(test, **kwargs):
+    # an NSCAReceiver on a free port, stopped when the test is done
+    receiver = pynsca.NSCAReceiver('127.0.0.1', 0, **kwargs)
+    receiver.start()
+    test.addCleanup(receiver.stop)
+    return receiver
+
+def dead_address():
+    # a port with nothing listening on it
+    sk = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sk.bind(('127.0.0.1', 0))
+    address = sk.getsockname()
+    sk.close()
+    return address
 
 class TestConstants(unittest.TestCase):
 
@@ -81,7 +103,7 @@ class TestNetwork(unittest.TestCase):
         assert self.from_server is not None
         sock.send(self.from_server)
 
-        buf = ''
+        buf = b''
         while 1:
             data = sock.recv(1024)
             if not data:
@@ -95,6 +117,15 @@ class TestNetwork(unittest.TestCase):
         bytes = base64.b64decode(b64)
         self.from_server = bytes
 
+    xor_banner = """
+        unvxWHaOSEOA67AxsyjFCCOJ5i2d8pz5uHVA7A2ilccehh+UFWfXlVOIxwawjQ/UFvYBs
+        +mdraET7o4gkCTnrqoHQsBvGlbDoh7KU6vZJ8HQKHW5xiJb2RDq+aAO4U+56ZJ5WKzQHE
+        /u5qKZwMpbkPPQSrnzpZMDj42knW7zVlhNubCx
+    """
+
+    def notif_banner(self):
+        return pynsca.NSCANotifier('')._decode_from_server(self.from_server)
+
     def assertGotB64(self, b64):
         self.server_thread.join()
         self.assertEqual(self.got_from_client, base64.b64decode(b64))
@@ -154,6 +185,1038 @@ class TestNetwork(unittest.TestCase):
             2OxivHebadKE9czMe4/jSPFJj8/HbyOtB3s7q8NzojLGsUas
         """)
 
+    def test_svc_results_one_connection(self):
+        self.setServerBannerB64(self.xor_banner)
+        iv, timestamp = self.notif_banner()
+
+        notif = pynsca.NSCANotifier('127.0.0.1', self.port)
+        sent = notif.svc_results([
+            ('linux-ix-slave10.build', 'buildbot-start', 0, 'hello!'),
+            ('linux-ix-slave10.build', '', 2, 'down'),
+        ])
+
+        self.assertEqual(sent, 2)
+        self.server_thread.join()
+        self.assertEqual(self.got_from_client,
+            notif._encode_to_server(iv, timestamp, 0,
+                'linux-ix-slave10.build', 'buildbot-start', 'hello!') +
+            notif._encode_to_server(iv, timestamp, 2,
+                'linux-ix-slave10.build', '', 'down'))
+
+    def test_svc_results_reports_partial_send(self):
+        self.setServerBannerB64(self.xor_banner)
+
+        notif = pynsca.NSCANotifier('127.0.0.1', self.port)
+        try:
+            notif.svc_results([
+                ('host', 'svc', 0, 'ok'),
+                ('host', 'svc', -1, 'bad return code'),
+            ])
+        except pynsca.NSCASendError as e:
+            self.assertEqual(e.sent, 1)
+        else:
+            self.fail("NSCASendError not raised")
+
+        self.server_thread.join()
+        self.assertEqual(len(self.got_from_client), notif.toserver_fmt_size)
+
+    def test_session(self):
+        self.setServerBannerB64(self.xor_banner)
+        iv, timestamp = self.notif_banner()
+
+        notif = pynsca.NSCANotifier('127.0.0.1', self.port, password='ham')
+        with notif.session() as session:
+            session.host_result('web1', pynsca.UP, 'PING OK')
+            session.svc_result('web1', 'http', pynsca.WARNING, 'slow')
+            self.assertEqual(session.sent, 2)
+
+        self.server_thread.join()
+        self.assertEqual(self.got_from_client,
+            notif._encode_to_server(iv, timestamp, 0, 'web1', '', 'PING OK',
+                1, 'ham') +
+            notif._encode_to_server(iv, timestamp, 1, 'web1', 'http', 'slow',
+                1, 'ham'))
+
+class RecordingNotifier(pynsca.NSCANotifier):
+    """
+    Notifier whose multi-result sends are recorded rather than sent, and
+    can be held up by clearing C{self.unblocked}.
+    """
+
+    def __init__(self, *args, **kwargs):
+        pynsca.NSCANotifier.__init__(self, *args, **kwargs)
+        self.batches = []
+        self.unblocked = threading.Event()
+        self.unblocked.set()
+
+    def svc_results(self, results, timeout=5):
+        self.unblocked.wait()
+        self.batches.append(list(results))
+        return len(self.batches[-1])
+
+class TestQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.notif = RecordingNotifier('127.0.0.1')
+
+    def tearDown(self):
+        self.notif.unblocked.set()
+        self.notif.stop_queue(1)
+
+    def test_queued_results_are_sent(self):
+        self.notif.start_queue(batch_size=2)
+        for i in range(5):
+            self.notif.svc_result('web%d' % i, 'http', pynsca.OK, 'fine')
+        self.notif.host_result('web0', pynsca.UP, 'PING OK')
+        self.assertTrue(self.notif.flush(5))
+
+        sent = [r for batch in self.notif.batches for r in batch]
+        self.assertEqual(sent[-1], ('web0', '', pynsca.UP, 'PING OK'))
+        self.assertEqual(len(sent), 6)
+        self.assertTrue(max([len(b) for b in self.notif.batches]) <= 2)
+        self.assertEqual(self.notif.queue_stats(),
+                dict(queued=0, sent=6, dropped=0, failed=0, overdue=0))
+
+    def fill_blocked_queue(self, overflow):
+        self.notif.unblocked.clear()
+        self.notif.start_queue(maxsize=2, overflow=overflow, batch_size=1)
+        self.notif.svc_result('in-flight', 'svc', 0, '')
+        while self.notif.queue_stats()['queued'] != 1 or self.notif._sender.queue:
+            time.sleep(0.01)
+        for name in ('a', 'b', 'c'):
+            self.notif.svc_result(name, 'svc', 0, '')
+        self.notif.unblocked.set()
+        self.assertTrue(self.notif.flush(5))
+        return [batch[0][0] for batch in self.notif.batches]
+
+    def test_drop_oldest(self):
+        self.assertEqual(self.fill_blocked_queue(pynsca.DROP_OLDEST),
+                ['in-flight', 'b', 'c'])
+        self.assertEqual(self.notif.queue_stats()['dropped'], 1)
+
+    def test_drop_newest(self):
+        self.assertEqual(self.fill_blocked_queue(pynsca.DROP_NEWEST),
+                ['in-flight', 'a', 'b'])
+        self.assertEqual(self.notif.queue_stats()['dropped'], 1)
+
+    def test_urgent_results_go_first(self):
+        self.notif.unblocked.clear()
+        self.notif.start_queue(batch_size=1)
+        self.notif.svc_result('in-flight', 'svc', 0, '')
+        while self.notif.queue_stats()['queued'] != 1 or self.notif._sender.queue:
+            time.sleep(0.01)
+        self.notif.svc_result('a', 'svc', pynsca.OK, '')
+        self.notif.svc_result('b', 'svc', pynsca.WARNING, '')
+        self.notif.svc_result('c', 'svc', pynsca.CRITICAL, '')
+        self.notif.svc_result('d', 'svc', pynsca.UNKNOWN, '')
+        self.notif.host_result('e', pynsca.UP, '', priority=1)
+        self.notif.unblocked.set()
+        self.assertTrue(self.notif.flush(5))
+        self.assertEqual([batch[0][0] for batch in self.notif.batches],
+                ['in-flight', 'e', 'c', 'd', 'b', 'a'])
+
+    def test_flush_timeout(self):
+        self.notif.unblocked.clear()
+        self.notif.start_queue()
+        self.notif.svc_result('web1', 'http', pynsca.OK, 'fine')
+        self.assertFalse(self.notif.flush(0.05))
+
+    def test_failures_are_counted(self):
+        notif = pynsca.NSCANotifier('127.0.0.1', 1)
+        notif.start_queue()
+        notif.svc_result('web1', 'http', pynsca.OK, 'fine')
+        self.assertTrue(notif.flush(5))
+        self.assertEqual(notif.queue_stats(),
+                dict(queued=0, sent=0, dropped=0, failed=1, overdue=0))
+        notif.stop_queue()
+
+class TestScheduler(unittest.TestCase):
+
+    def pop_all(self, scheduler):
+        popped = []
+        while scheduler:
+            popped.append([r[:2] for r in scheduler.pop()])
+        return popped
+
+    def test_hosts_take_turns(self):
+        scheduler = pynsca._Scheduler(None)
+        for i in range(3):
+            scheduler.append(('busy', 'svc%d' % i, pynsca.OK, ''))
+        scheduler.append(('quiet', 'svc', pynsca.OK, ''))
+        self.assertEqual(self.pop_all(scheduler), [
+            [('busy', 'svc0')], [('quiet', 'svc')],
+            [('busy', 'svc1')], [('busy', 'svc2')]])
+
+    def test_results_for_a_service_stay_in_order(self):
+        scheduler = pynsca._Scheduler(None)
+        scheduler.append(('web1', 'http', pynsca.OK, 'old'))
+        scheduler.append(('web2', 'http', pynsca.WARNING, ''))
+        scheduler.append(('web1', 'http', pynsca.CRITICAL, 'new'))
+        self.assertEqual(len(scheduler), 3)
+        self.assertEqual([r[3] for r in scheduler.pop()], ['old', 'new'])
+        self.assertEqual(len(scheduler), 1)
+
+    def test_max_delay(self):
+        scheduler = pynsca._Scheduler(0.05)
+        scheduler.append(('web1', 'http', pynsca.OK, ''))
+        time.sleep(0.1)
+        scheduler.append(('web2', 'http', pynsca.CRITICAL, ''))
+        self.assertEqual(self.pop_all(scheduler),
+                         [[('web1', 'http')], [('web2', 'http')]])
+        self.assertEqual(scheduler.overdue, 1)
+
+    def test_drop_least_urgent(self):
+        scheduler = pynsca._Scheduler(None)
+        scheduler.append(('web1', 'http', pynsca.CRITICAL, ''))
+        scheduler.append(('web2', 'http', pynsca.OK, ''))
+        scheduler.append(('web3', 'http', pynsca.OK, ''))
+        scheduler.drop()
+        self.assertEqual(self.pop_all(scheduler),
+                         [[('web1', 'http')], [('web3', 'http')]])
+
+    def test_left_behind_entries_are_discarded(self):
+        for max_delay in (None, 60):
+            scheduler = pynsca._Scheduler(max_delay)
+            for i in range(1000):
+                # a busy host whose results become urgent, and a quiet one
+                # that stays queued at the bottom level throughout
+                scheduler.append(('web1', 'http', pynsca.OK, ''))
+                scheduler.append(('web1', 'http', pynsca.CRITICAL, ''))
+                scheduler.append(('web%d' % (i % 50 + 2), 'http',
+                                  pynsca.WARNING, ''))
+                scheduler.pop()
+                scheduler.pop()
+            self.assertTrue(len(scheduler.arrivals) < 200)
+            for hosts, arrivals in scheduler.levels.values():
+                self.assertTrue(len(arrivals) < 200)
+                self.assertTrue(sum(map(len, hosts.values())) < 200)
+            if max_delay is None:
+                self.assertEqual(len(scheduler.arrivals), 0)
+
+class TestReceiver(unittest.TestCase):
+
+    def get_results(self, receiver, count):
+        return [receiver.results.get(timeout=5) for i in range(count)]
+
+    def test_all_encryption_modes(self):
+        modes = [(0, None), (1, None), (1, 'ham'), (16, '1234')]
+        if pynsca.DES:
+            modes.extend([(2, 'pw'), (3, 'abcdefghijklmnopqrstuvwx'),
+                          (4, 'pw'), (8, 'pw')])
+        for mode, password in modes:
+            receiver = start_receiver(self, encryption_mode=mode, password=password)
+            notif = pynsca.NSCANotifier('127.0.0.1', receiver.port,
+                    encryption_mode=mode, password=password)
+            notif.svc_results([('web1', 'http', pynsca.WARNING, 'slow\nish'),
+                               ('web1', '', pynsca.UP, 'PING OK')])
+
+            results = self.get_results(receiver, 2)
+            self.assertEqual([r[:4] for r in results], [
+                ('web1', 'http', pynsca.WARNING, 'slow\\nish'),
+                ('web1', '', pynsca.UP, 'PING OK')])
+            self.assertTrue(abs(results[0].timestamp - time.time()) < 5)
+
+    def test_concurrent_connections(self):
+        results = []
+        receiver = start_receiver(self, callback=results.append)
+        notif = pynsca.NSCANotifier('127.0.0.1', receiver.port)
+        threads = [threading.Thread(target=notif.svc_results,
+                        args=([('web%d' % i, 'svc%d' % j, 0, '')
+                               for j in range(10)],))
+                   for i in range(10)]
+        for thd in threads:
+            thd.start()
+        for thd in threads:
+            thd.join()
+        for i in range(500):
+            if len(results) == 100:
+                break
+            time.sleep(0.01)
+        self.assertEqual(len(results), 100)
+        self.assertEqual(receiver.stats(),
+                dict(connections=10, packets=100, rejected=0))
+
+    def test_wrong_password_is_rejected(self):
+        receiver = start_receiver(self, password='right')
+        notif = pynsca.NSCANotifier('127.0.0.1', receiver.port,
+                password='wrong')
+        notif.svc_result('web1', 'http', 0, 'ok')
+        for i in range(500):
+            if receiver.stats()['rejected']:
+                break
+            time.sleep(0.01)
+        self.assertEqual(receiver.stats(),
+                dict(connections=1, packets=0, rejected=1))
+        self.assertTrue(receiver.results.empty())
+
+class TestDispatch(unittest.TestCase):
+
+    def test_dispatch(self):
+        receiver = start_receiver(self, password='ham')
+        notif = pynsca.NSCANotifier('127.0.0.1', receiver.port,
+                                    password='ham')
+        results = [('web%d' % (i % 10), 'http', pynsca.OK, str(i))
+                   for i in range(100)]
+        self.assertEqual(notif.dispatch(results, connections=4), [None] * 100)
+
+        received = [receiver.results.get(timeout=5) for i in range(100)]
+        self.assertEqual(receiver.stats()['connections'], 4)
+        # each host's results arrived in order
+        for host in set([r[0] for r in results]):
+            outputs = [int(r.plugin_output) for r in received
+                       if r.host_name == host]
+            self.assertEqual(outputs, sorted(outputs))
+            self.assertEqual(len(outputs), 10)
+
+    def test_dispatch_failure(self):
+        notif = pynsca.NSCANotifier('127.0.0.1', 1)
+        outcomes = notif.dispatch([('web1', 'http', 0, 'ok'),
+                                   ('web2', 'http', 0, 'ok')], connections=2)
+        self.assertEqual(len(outcomes), 2)
+        for outcome in outcomes:
+            self.assertTrue(isinstance(outcome, socket.error))
+
+    def test_dispatch_needs_a_connection(self):
+        notif = pynsca.NSCANotifier('127.0.0.1', 1)
+        self.assertRaises(ValueError, notif.dispatch,
+                          [('web1', 'http', 0, 'ok')], connections=0)
+
+    def test_dispatch_to_all(self):
+        receivers = [start_receiver(self) for i in range(2)]
+        notif = pynsca.NSCANotifier([('127.0.0.1', receivers[0].port),
+                                     dead_address(),
+                                     ('127.0.0.1', receivers[1].port)],
+                                    send_to_all=True)
+        results = [('web%d' % i, 'http', pynsca.OK, 'fine') for i in range(6)]
+        self.assertEqual(notif.dispatch(results, connections=2), [None] * 6)
+        for receiver in receivers:
+            self.assertEqual(
+                sorted([receiver.results.get(timeout=5)[:2]
+                        for i in range(6)]),
+                [('web%d' % i, 'http') for i in range(6)])
+            self.assertEqual(receiver.stats()['connections'], 2)
+
+class TestPool(unittest.TestCase):
+
+    def setUp(self):
+        self.receiver = start_receiver(self)
+        self.notif = pynsca.NSCANotifier('127.0.0.1', self.receiver.port)
+        self.addCleanup(self.notif.stop_pool)
+
+    def wait_ready(self, count):
+        deadline = time.time() + 5
+        while self.notif.pool_stats()['ready'] < count:
+            self.assertTrue(time.time() < deadline, "pool never filled")
+            time.sleep(0.01)
+
+    def test_sends_use_ready_connections(self):
+        self.notif.start_pool(size=2)
+        self.wait_ready(2)
+        self.notif.svc_result('web1', 'http', pynsca.OK, 'fine')
+        self.notif.svc_results([('web2', 'http', pynsca.OK, 'fine'),
+                                ('web2', '', pynsca.UP, 'PING OK')])
+        self.assertEqual(
+            sorted([self.receiver.results.get(timeout=5)[:2]
+                    for i in range(3)]),
+            [('web1', 'http'), ('web2', ''), ('web2', 'http')])
+
+        stats = self.notif.pool_stats()
+        self.assertEqual((stats['size'], stats['hits'], stats['misses']),
+                         (2, 2, 0))
+        # used connections went back to the pool
+        self.assertEqual(self.receiver.stats()['connections'], 2)
+
+    def test_stale_connections_are_replaced(self):
+        self.notif.start_pool(size=1, max_age=0.2)
+        self.wait_ready(1)
+        time.sleep(0.3)
+        self.wait_ready(1)
+        self.notif.svc_result('web1', 'http', pynsca.OK, 'fine')
+        self.assertEqual(self.receiver.results.get(timeout=5)[:2],
+                         ('web1', 'http'))
+        self.assertTrue(self.notif.pool_stats()['replaced'] >= 1)
+        self.assertTrue(self.receiver.stats()['connections'] >= 2)
+
+    def test_closed_connections_are_replaced(self):
+        # a server that hangs up once the connection is in the pool
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(("127.0.0.1", 0))
+        sock.listen(5)
+        self.addCleanup(sock.close)
+        hang_up = threading.Event()
+        def server():
+            conn, addr = sock.accept()
+            conn.sendall(b'\0' * 132)
+            hang_up.wait(5)
+            conn.close()
+        thd = threading.Thread(target=server)
+        thd.daemon = True
+        thd.start()
+
+        notif = pynsca.NSCANotifier('127.0.0.1', sock.getsockname()[1])
+        self.addCleanup(notif.stop_pool)
+        notif.start_pool(size=1)
+        deadline = time.time() + 5
+        while notif.pool_stats()['ready'] < 1:
+            self.assertTrue(time.time() < deadline, "pool never filled")
+            time.sleep(0.01)
+        hang_up.set()
+        thd.join(5)
+        time.sleep(0.1)
+        self.assertEqual(notif._pool.get(), None)
+        stats = notif.pool_stats()
+        self.assertEqual((stats['hits'], stats['replaced']), (0, 1))
+
+    def test_stop_pool(self):
+        self.notif.start_pool(size=1)
+        self.wait_ready(1)
+        self.notif.stop_pool()
+        self.assertEqual(self.notif.pool_stats()['ready'], 0)
+        self.notif.svc_result('web1', 'http', pynsca.OK, 'fine')
+        self.assertEqual(self.receiver.results.get(timeout=5)[:2],
+                         ('web1', 'http'))
+
+class TestFailover(unittest.TestCase):
+
+    def test_failover_skips_dead_server(self):
+        backup = start_receiver(self)
+        notif = pynsca.NSCANotifier([dead_address(),
+                                     ('127.0.0.1', backup.port)],
+                                    failure_threshold=1)
+        notif.svc_result('web1', 'http', pynsca.OK, 'one')
+        notif.svc_result('web1', 'http', pynsca.OK, 'two')
+        self.assertEqual([backup.results.get(timeout=5)[3] for i in range(2)],
+                         ['one', 'two'])
+
+        primary, secondary = notif.server_health()
+        self.assertEqual((primary['state'], primary['consecutive_failures']),
+                         ('open', 1))
+        self.assertTrue(isinstance(primary['last_error'], socket.error))
+        self.assertEqual(secondary['state'], 'closed')
+        self.assertTrue(secondary['latency'] is not None)
+
+    def test_half_open_probe(self):
+        primary = start_receiver(self)
+        backup = start_receiver(self)
+        notif = pynsca.NSCANotifier([('127.0.0.1', primary.port),
+                                     ('127.0.0.1', backup.port)],
+                                    failure_threshold=1, retry_interval=0)
+        notif._servers[0].failed(socket.error("down"))
+        self.assertEqual(notif.server_health()[0]['state'], 'half-open')
+        notif.svc_result('web1', 'http', pynsca.OK, 'fine')
+        self.assertEqual(primary.results.get(timeout=5)[3], 'fine')
+        self.assertEqual(notif.server_health()[0]['state'], 'closed')
+
+    def test_all_servers_down(self):
+        notif = pynsca.NSCANotifier([dead_address()], failure_threshold=1)
+        self.assertRaises(socket.error, notif.svc_result,
+                          'web1', 'http', pynsca.OK, 'fine')
+        # the second attempt fails without trying the server
+        self.assertRaises(socket.error, notif.svc_result,
+                          'web1', 'http', pynsca.OK, 'fine')
+        self.assertEqual(notif.server_health()[0]['consecutive_failures'], 1)
+
+    def test_send_to_all(self):
+        first, second = start_receiver(self), start_receiver(self)
+        notif = pynsca.NSCANotifier([('127.0.0.1', first.port),
+                                     ('127.0.0.1', second.port),
+                                     dead_address()],
+                                    send_to_all=True)
+        self.assertEqual(notif.svc_results([('web1', 'http', 0, 'fine'),
+                                            ('web1', '', 0, 'PING OK')]), 2)
+        for receiver in first, second:
+            self.assertEqual(
+                [receiver.results.get(timeout=5)[:2] for i in range(2)],
+                [('web1', 'http'), ('web1', '')])
+        self.assertEqual(notif.server_health()[2]['consecutive_failures'], 1)
+
+class TestResolver(unittest.TestCase):
+
+    def setUp(self):
+        self.receiver = start_receiver(self)
+        self.lookups = []
+        self.addresses = [(socket.AF_INET, socket.SOCK_STREAM, 6, '',
+                           ('127.0.0.1', self.receiver.port))]
+        real_getaddrinfo = socket.getaddrinfo
+        def getaddrinfo(host, *args):
+            if host != 'nagios.example.com':
+                return real_getaddrinfo(host, *args)
+            self.lookups.append(host)
+            if self.addresses is None:
+                raise socket.gaierror(socket.EAI_NONAME, "not found")
+            return list(self.addresses)
+        socket.getaddrinfo = getaddrinfo
+        self.addCleanup(setattr, socket, 'getaddrinfo', real_getaddrinfo)
+
+    def notifier(self, **kwargs):
+        return pynsca.NSCANotifier('nagios.example.com', self.receiver.port,
+                                   **kwargs)
+
+    def test_addresses_are_cached(self):
+        notif = self.notifier()
+        notif.svc_result('web1', 'http', pynsca.OK, 'one')
+        notif.svc_result('web1', 'http', pynsca.OK, 'two')
+        self.assertEqual([self.receiver.results.get(timeout=5)[3]
+                          for i in range(2)], ['one', 'two'])
+        self.assertEqual(len(self.lookups), 1)
+
+    def test_failed_lookups_are_cached(self):
+        self.addresses = None
+        notif = self.notifier()
+        for i in range(2):
+            self.assertRaises(socket.gaierror, notif.svc_result,
+                              'web1', 'http', pynsca.OK, 'fine')
+        self.assertEqual(len(self.lookups), 1)
+
+    def test_old_addresses_outlive_resolver_failure(self):
+        notif = self.notifier(resolver_ttl=0)
+        notif.svc_result('web1', 'http', pynsca.OK, 'one')
+        self.addresses = None
+        notif.svc_result('web1', 'http', pynsca.OK, 'two')
+        self.assertEqual([self.receiver.results.get(timeout=5)[3]
+                          for i in range(2)], ['one', 'two'])
+        self.assertEqual(len(self.lookups), 2)
+
+    def test_falls_back_to_next_address(self):
+        self.addresses.insert(0, (socket.AF_INET, socket.SOCK_STREAM, 6, '',
+                                  dead_address()))
+        notif = self.notifier()
+        notif.svc_result('web1', 'http', pynsca.OK, 'fine')
+        self.assertEqual(self.receiver.results.get(timeout=5)[3], 'fine')
+
+    def test_falls_back_past_unsupported_family(self):
+        real_socket = socket.socket
+        class NoIPv6Socket(real_socket):
+            def __init__(self, family=socket.AF_INET, *args, **kwargs):
+                if family == socket.AF_INET6:
+                    raise socket.error(errno.EAFNOSUPPORT,
+                                       "Address family not supported")
+                real_socket.__init__(self, family, *args, **kwargs)
+        socket.socket = NoIPv6Socket
+        self.addCleanup(setattr, socket, 'socket', real_socket)
+        self.addresses.insert(0, (socket.AF_INET6, socket.SOCK_STREAM, 6, '',
+                                  ('::1', self.receiver.port, 0, 0)))
+        notif = self.notifier()
+        notif.svc_result('web1', 'http', pynsca.OK, 'fine')
+        self.assertEqual(self.receiver.results.get(timeout=5)[3], 'fine')
+
+    def test_interleave_families(self):
+        v4 = [(socket.AF_INET, 'a'), (socket.AF_INET, 'b')]
+        v6 = [(socket.AF_INET6, 'c'), (socket.AF_INET6, 'd'),
+              (socket.AF_INET6, 'e')]
+        self.assertEqual(
+            [a[1] for a in pynsca._interleave_families(v6 + v4)],
+            ['c', 'a', 'd', 'b', 'e'])
+
+class TestRateController(unittest.TestCase):
+
+    def test_token_bucket(self):
+        rate = pynsca.RateController(rate=100, burst=2)
+        start = time.time()
+        for i in range(7):
+            rate.acquire()
+        # two tokens up front, then one every 10ms
+        self.assertTrue(time.time() - start >= 0.04)
+        stats = rate.stats()
+        self.assertEqual(stats['acquired'], 7)
+        self.assertTrue(stats['throttled'] >= 1)
+        self.assertTrue(stats['throttle_time'] > 0)
+
+    def test_aimd(self):
+        rate = pynsca.RateController(rate=100, target_latency=0.1,
+                                     increase=10, cooldown=60)
+        for i in range(100):
+            rate.record(0.01)
+        self.assertTrue(109 < rate.rate < 111, rate.rate)
+        rate.record(error=socket.timeout())
+        self.assertTrue(54 < rate.rate < 56, rate.rate)
+        # further bad news within the cooldown does not slow down again
+        rate.record(error=socket.timeout())
+        for i in range(20):
+            rate.record(1.0)
+        stats = rate.stats()
+        self.assertEqual((stats['errors'], stats['decreases']), (2, 1))
+        self.assertTrue(stats['latency'] > 0.1)
+
+    def test_sends_do_not_dilute_connection_latency(self):
+        rate = pynsca.RateController(rate=100, target_latency=0.5,
+                                     cooldown=0)
+        for i in range(5):
+            # a slow banner, followed by many quick sends
+            rate.record(1.0)
+            for j in range(50):
+                rate.record()
+        stats = rate.stats()
+        self.assertEqual(stats['latency'], 1.0)
+        self.assertTrue(stats['decreases'] >= 5)
+        self.assertTrue(rate.rate < 100)
+
+    def test_replays_are_limited_and_reported(self):
+        receiver = start_receiver(self)
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        spool = pynsca.NSCASpool(os.path.join(tmpdir, 'spool'))
+        spool.extend([('web1', 'http', 0, 'ok'), ('web2', 'http', 0, 'ok')])
+        rate = pynsca.RateController()
+        notif = pynsca.NSCANotifier('127.0.0.1', receiver.port,
+                                    rate_controller=rate)
+        session = notif.session()
+        self.addCleanup(session.close)
+        self.assertEqual(spool.replay(session), 2)
+        self.assertEqual(rate.stats()['acquired'], 3)
+
+        spool.append('web3', 'http', 0, 'ok')
+        session.sock.close()
+        self.assertRaises(socket.error, spool.replay, session)
+        self.assertEqual(rate.stats()['errors'], 1)
+
+    def test_acquire_more_than_burst(self):
+        rate = pynsca.RateController(burst=2)
+        self.assertRaises(ValueError, rate.acquire, 3)
+
+    def test_min_rate(self):
+        rate = pynsca.RateController(rate=4, min_rate=2, cooldown=0)
+        for i in range(5):
+            rate.record(error=socket.error())
+        self.assertEqual(rate.rate, 2)
+
+    def test_notifier_reports_to_controller(self):
+        receiver = start_receiver(self)
+        rate = pynsca.RateController()
+        notif = pynsca.NSCANotifier('127.0.0.1', receiver.port,
+                                    rate_controller=rate)
+        notif.svc_results([('web1', 'http', 0, 'ok'), ('web2', 'http', 0, 'ok')])
+        self.assertEqual(receiver.results.get(timeout=5)[0], 'web1')
+        # one token for the connection, one per packet
+        self.assertEqual(rate.stats()['acquired'], 3)
+        self.assertTrue(rate.rate > 100)
+
+        dead = pynsca.NSCANotifier('127.0.0.1', 1, rate_controller=rate)
+        self.assertRaises(socket.error, dead.svc_result,
+                          'web1', 'http', 0, 'ok')
+        self.assertEqual(rate.stats()['errors'], 1)
+        self.assertTrue(rate.rate < 100)
+
+class TestInstrumentation(unittest.TestCase):
+
+    def setUp(self):
+        self.timings = []
+        self.notif = pynsca.NSCANotifier('127.0.0.1', 0)
+        self.notif.enable_instrumentation(self.timings.append)
+
+    def listen(self, banner):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(("127.0.0.1", 0))
+        sock.listen(5)
+        self.addCleanup(sock.close)
+        def server():
+            conn, addr = sock.accept()
+            conn.sendall(banner)
+            time.sleep(0.5)
+            conn.close()
+        thd = threading.Thread(target=server)
+        thd.daemon = True
+        thd.start()
+        self.notif.monitoring_port = sock.getsockname()[1]
+
+    def test_disabled_by_default(self):
+        self.assertEqual(pynsca.NSCANotifier('127.0.0.1').stats(), None)
+
+    def test_sends_are_timed_and_counted(self):
+        receiver = start_receiver(self)
+        self.notif.monitoring_port = receiver.port
+        self.notif.svc_results([('web1', 'http', 0, 'ok'),
+                                ('web1', 'https', 0, 'ok')])
+
+        self.assertEqual(sorted(self.timings[0]),
+                ['banner', 'connect', 'encode', 'encrypt', 'send'])
+        self.assertEqual(sorted(self.timings[1]), ['encode', 'encrypt', 'send'])
+        self.assertEqual(self.notif.stats(), dict(connections=1, sends=2,
+                bytes=2 * self.notif.toserver_fmt_size, timeouts=0,
+                short_banners=0, failures={}))
+
+    def test_short_banner(self):
+        self.listen(b'short')
+        self.assertRaises(pynsca.NSCAPacketError, self.notif.svc_result,
+                          'web1', 'http', 0, 'ok')
+        stats = self.notif.stats()
+        self.assertEqual((stats['short_banners'], stats['failures']),
+                         (1, {'NSCAPacketError': 1}))
+
+    def test_timeout(self):
+        self.listen(b'')
+        self.assertRaises(socket.timeout, self.notif.svc_result,
+                          'web1', 'http', 0, 'ok', timeout=0.1)
+        stats = self.notif.stats()
+        self.assertEqual((stats['timeouts'], stats['failures']),
+                         (1, {socket.timeout.__name__: 1}))
+
+class TestCoalescingNotifier(unittest.TestCase):
+
+    def setUp(self):
+        self.notif = RecordingNotifier('127.0.0.1')
+        self.sent = []
+        self.notif.svc_result = lambda *result: self.sent.append(result)
+
+    def test_repeats_are_suppressed(self):
+        coalescing = pynsca.CoalescingNotifier(self.notif)
+        self.assertTrue(coalescing.svc_result('web1', 'http', 0, 'ok'))
+        self.assertFalse(coalescing.svc_result('web1', 'http', 0, 'ok'))
+        self.assertTrue(coalescing.svc_result('web1', 'http', 2, 'ok'))
+        self.assertTrue(coalescing.svc_result('web1', 'http', 2, 'down'))
+        self.assertTrue(coalescing.host_result('web1', pynsca.UP, 'PING OK'))
+        self.assertFalse(coalescing.host_result('web1', pynsca.UP, 'PING OK'))
+
+        self.assertEqual(self.sent, [('web1', 'http', 0, 'ok'),
+                                     ('web1', 'http', 2, 'ok'),
+                                     ('web1', 'http', 2, 'down'),
+                                     ('web1', '', 0, 'PING OK')])
+        self.assertEqual(coalescing.stats(), dict(forwarded=4, suppressed=2,
+                                                  entries=2, evicted=0))
+
+    def test_heartbeat(self):
+        coalescing = pynsca.CoalescingNotifier(self.notif, heartbeat=0.05)
+        coalescing.svc_result('web1', 'http', 0, 'ok')
+        self.assertFalse(coalescing.svc_result('web1', 'http', 0, 'ok'))
+        time.sleep(0.1)
+        self.assertTrue(coalescing.svc_result('web1', 'http', 0, 'ok'))
+
+    def test_max_entries(self):
+        coalescing = pynsca.CoalescingNotifier(self.notif, max_entries=2)
+        for host in ('web1', 'web2', 'web3', 'web1'):
+            coalescing.svc_result(host, 'http', 0, 'ok')
+        self.assertEqual(len(self.sent), 4)
+        self.assertEqual(coalescing.stats()['evicted'], 2)
+
+    def test_svc_results(self):
+        coalescing = pynsca.CoalescingNotifier(self.notif)
+        coalescing.svc_result('web1', 'http', 0, 'ok')
+        self.assertEqual(coalescing.svc_results([('web1', 'http', 0, 'ok'),
+                                                 ('web2', 'http', 0, 'ok')]), 1)
+        self.assertEqual(self.notif.batches, [[('web2', 'http', 0, 'ok')]])
+
+    def test_failed_sends_are_not_remembered(self):
+        def fail(*result):
+            raise socket.error("down")
+        self.notif.svc_result = fail
+        coalescing = pynsca.CoalescingNotifier(self.notif)
+        self.assertRaises(socket.error, coalescing.svc_result,
+                          'web1', 'http', 0, 'ok')
+        self.assertEqual(coalescing.stats()['entries'], 0)
+
+class TestShardedNotifier(unittest.TestCase):
+
+    def setUp(self):
+        self.shards = dict(('poller%d' % i, RecordingNotifier('127.0.0.1'))
+                           for i in range(4))
+        self.sharded = pynsca.ShardedNotifier(self.shards)
+        self.hosts = ['web%d' % i for i in range(1000)]
+
+    def test_results_go_to_the_hosts_shard(self):
+        sent = []
+        for name, notif in self.shards.items():
+            notif.svc_result = (lambda name: lambda *result:
+                                sent.append((name,) + result))(name)
+        self.sharded.svc_result('web1', 'http', 0, 'ok')
+        self.sharded.host_result('web1', pynsca.UP, 'PING OK')
+        name = self.sharded.shard_for('web1')
+        self.assertEqual(sent, [(name, 'web1', 'http', 0, 'ok'),
+                                (name, 'web1', '', 0, 'PING OK')])
+
+    def test_svc_results_are_batched_per_shard(self):
+        results = [(host, 'http', 0, 'ok') for host in self.hosts]
+        self.assertEqual(self.sharded.svc_results(results), 1000)
+        for name, notif in self.shards.items():
+            self.assertEqual(len(notif.batches), 1)
+            hosts = [r[0] for r in notif.batches[0]]
+            self.assertTrue(hosts)
+            for host in hosts:
+                self.assertEqual(self.sharded.shard_for(host), name)
+
+    def test_adding_a_shard_moves_few_hosts(self):
+        before = dict((h, self.sharded.shard_for(h)) for h in self.hosts)
+        self.sharded.add_shard('poller4', RecordingNotifier('127.0.0.1'))
+        after = dict((h, self.sharded.shard_for(h)) for h in self.hosts)
+        moved = [h for h in self.hosts if before[h] != after[h]]
+        # only hosts taken over by the new shard move; about a fifth
+        self.assertEqual(set([after[h] for h in moved]), set(['poller4']))
+        self.assertTrue(100 < len(moved) < 300, len(moved))
+
+        self.sharded.remove_shard('poller4')
+        self.assertEqual(
+            dict((h, self.sharded.shard_for(h)) for h in self.hosts), before)
+
+class TestSpool(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, 'spool')
+
+    def replay(self, spool, receiver):
+        notif = pynsca.NSCANotifier('127.0.0.1', receiver.port)
+        session = notif.session()
+        try:
+            return spool.replay(session)
+        finally:
+            session.close()
+
+    def test_survives_reopening(self):
+        now = int(time.time())
+        spool = pynsca.NSCASpool(self.path, capacity=4)
+        spool.append('web1', 'http', 2, 'down', timestamp=now - 5)
+        spool.append('web1', 'http', 0, 'up', timestamp=now - 1)
+        spool.close()
+
+        spool = pynsca.NSCASpool(self.path)
+        self.assertEqual((len(spool), spool.capacity), (2, 4))
+        receiver = start_receiver(self)
+        self.assertEqual(self.replay(spool, receiver), 2)
+        self.assertEqual(
+            [receiver.results.get(timeout=5) for i in range(2)],
+            [('web1', 'http', 2, 'down', now - 5),
+             ('web1', 'http', 0, 'up', now - 1)])
+        self.assertEqual(spool.stats(),
+                         dict(spooled=0, dropped=0, replayed=2))
+
+    def test_old_results_are_restamped(self):
+        spool = pynsca.NSCASpool(self.path, max_packet_age=30)
+        spool.append('web1', 'http', 2, 'down', timestamp=1000)
+        receiver = start_receiver(self)
+        self.replay(spool, receiver)
+        result = receiver.results.get(timeout=5)
+        self.assertEqual(result[:4], ('web1', 'http', 2, 'down'))
+        self.assertTrue(abs(result.timestamp - time.time()) < 5)
+
+    def test_overflow(self):
+        for overflow, kept in [(pynsca.DROP_OLDEST, ['b', 'c']),
+                               (pynsca.DROP_NEWEST, ['a', 'b'])]:
+            path = os.path.join(self.tmpdir, overflow)
+            spool = pynsca.NSCASpool(path, capacity=2, overflow=overflow)
+            for host in ('a', 'b', 'c'):
+                spool.append(host, 'svc', 0, '')
+            receiver = start_receiver(self)
+            self.replay(spool, receiver)
+            self.assertEqual([receiver.results.get(timeout=5).host_name
+                              for i in range(2)], kept)
+            self.assertEqual(spool.stats()['dropped'], 1)
+
+    class Session(object):
+        # records the host name of each packet replayed over it
+        timestamp = int(time.time())
+        def __init__(self, sent, during_send=None):
+            self.sent = sent
+            self.during_send = during_send
+        def _send_packet(self, toserver_pkt):
+            if self.during_send is not None:
+                self.during_send()
+            else:
+                time.sleep(0.001)
+            host_name = bytes(toserver_pkt[14:78]).rstrip(b'\0')
+            self.sent.append(host_name.decode('ascii'))
+
+    def test_concurrent_replays_and_appends(self):
+        spool = pynsca.NSCASpool(self.path, capacity=8)
+        for i in range(8):
+            spool.append('web%d' % i, 'http', 0, '')
+        sent = []
+        errors = []
+        def replay():
+            try:
+                spool.replay(self.Session(sent))
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=replay) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for i in range(8, 24):
+            spool.append('web%d' % i, 'http', 0, '')
+        for thread in threads:
+            thread.join()
+        spool.replay(self.Session(sent))
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(spool), 0)
+        # every record was either sent once or counted as dropped
+        self.assertEqual(len(sent), len(set(sent)))
+        self.assertEqual(len(sent) + spool.stats()['dropped'], 24)
+
+    def test_overflow_during_replay(self):
+        spool = pynsca.NSCASpool(self.path, capacity=2)
+        spool.append('a', 'svc', 0, '')
+        spool.append('b', 'svc', 0, '')
+        def append_c():
+            if not sent:
+                spool.append('c', 'svc', 0, '')
+        sent = []
+        spool.replay(self.Session(sent, append_c))
+        # a was already on its way when c pushed it out of the spool
+        self.assertEqual(sent, ['a', 'b', 'c'])
+        self.assertEqual(spool.stats(),
+                         dict(spooled=0, dropped=0, replayed=3))
+
+    def test_overflow_during_failed_replay(self):
+        spool = pynsca.NSCASpool(self.path, capacity=2)
+        spool.append('a', 'svc', 0, '')
+        spool.append('b', 'svc', 0, '')
+        def append_c_and_fail():
+            spool.append('c', 'svc', 0, '')
+            raise socket.error("connection reset")
+        self.assertRaises(socket.error, spool.replay,
+                          self.Session([], append_c_and_fail))
+        self.assertEqual(spool.stats(),
+                         dict(spooled=2, dropped=1, replayed=0))
+        sent = []
+        spool.replay(self.Session(sent))
+        self.assertEqual(sent, ['b', 'c'])
+
+    def test_not_a_spool(self):
+        f = open(self.path, 'w')
+        f.write('hello')
+        f.close()
+        self.assertRaises(ValueError, pynsca.NSCASpool, self.path)
+
+    def test_notifier_spools_and_replays(self):
+        spool = pynsca.NSCASpool(self.path)
+        notif = pynsca.NSCANotifier('127.0.0.1', 1, spool=spool)
+        notif.svc_result('web1', 'http', 2, 'down')
+        self.assertEqual(notif.svc_results([('web2', 'http', 2, 'down')]), 0)
+        self.assertEqual(len(spool), 2)
+
+        receiver = start_receiver(self)
+        notif.monitoring_port = receiver.port
+        notif.svc_result('web1', 'http', 0, 'up')
+        self.assertEqual(
+            [receiver.results.get(timeout=5)[:4] for i in range(3)],
+            [('web1', 'http', 2, 'down'), ('web2', 'http', 2, 'down'),
+             ('web1', 'http', 0, 'up')])
+        self.assertEqual(len(spool), 0)
+
+class TestRelay(unittest.TestCase):
+
+    def setUp(self):
+        if not hasattr(socket, 'AF_UNIX'):
+            raise unittest.SkipTest("Unix sockets not available")
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, 'relay.sock')
+
+        self.receiver = start_receiver(self)
+        self.upstream = pynsca.NSCANotifier('127.0.0.1', self.receiver.port)
+
+    def start_relay(self):
+        relay = pynsca.NSCARelay(self.path, self.upstream)
+        relay.start()
+        self.addCleanup(relay.stop)
+        return relay
+
+    def get_results(self, count):
+        return [self.receiver.results.get(timeout=5)[:4]
+                for i in range(count)]
+
+    def test_relay(self):
+        relay = self.start_relay()
+        client = pynsca.RelayNotifier(self.path)
+        client.svc_result('web1', 'http', pynsca.OK, 'fine')
+        client.host_result('web1', pynsca.UP, 'PING OK')
+        self.assertEqual(client.svc_results([('web2', 'http', 2, 'down'),
+                                             ('web3', 'http', 1, 'slow')]), 2)
+        self.assertEqual(sorted(self.get_results(4)), [
+            ('web1', '', 0, 'PING OK'), ('web1', 'http', 0, 'fine'),
+            ('web2', 'http', 2, 'down'), ('web3', 'http', 1, 'slow')])
+        client.close()
+
+        # the receiver can see a packet before the relay counts it
+        deadline = time.time() + 5
+        while relay.stats()['forwarded'] < 4 and time.time() < deadline:
+            time.sleep(0.01)
+        stats = relay.stats()
+        self.assertEqual((stats['received'], stats['forwarded']), (4, 4))
+        # all four results went over the relay's upstream connections
+        self.assertTrue(self.receiver.stats()['connections'] <= 2)
+
+    def test_client_reconnects(self):
+        relay = self.start_relay()
+        client = pynsca.RelayNotifier(self.path)
+        client.svc_result('web1', 'http', pynsca.OK, 'first')
+        self.assertEqual(self.get_results(1), [('web1', 'http', 0, 'first')])
+        relay.stop()
+
+        self.start_relay()
+        client.svc_result('web1', 'http', pynsca.OK, 'second')
+        self.assertEqual(self.get_results(1), [('web1', 'http', 0, 'second')])
+        client.close()
+
+    def test_corrupt_frame(self):
+        relay = self.start_relay()
+        sk = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sk.connect(self.path)
+        sk.sendall(b'x' * 720)
+        self.assertEqual(sk.recv(1), b'')
+        sk.close()
+        self.assertEqual(relay.stats()['rejected'], 1)
+
+class TestMain(unittest.TestCase):
+
+    def setUp(self):
+        self.receiver = start_receiver(self, password='sekrit')
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def run_main(self, args, input):
+        stdout, stderr = StringIO(), StringIO()
+        status = pynsca.main(['-H', '127.0.0.1',
+                              '-p', str(self.receiver.port)] + args,
+                             stdin=StringIO(input), stdout=stdout,
+                             stderr=stderr)
+        return status, stdout.getvalue(), stderr.getvalue()
+
+    def test_send_nsca_input(self):
+        config = os.path.join(self.tmpdir, 'send_nsca.cfg')
+        with open(config, 'w') as f:
+            f.write('# comment\npassword=sekrit\nencryption_method=1\n')
+        status, out, err = self.run_main(['-c', config],
+                'web1\thttp\t0\tfine\n'
+                'not a result\n'
+                'web1\t0\tPING OK\n')
+        self.assertEqual(status, 0)
+        self.assertEqual(out, '2 data packet(s) sent to host successfully.\n')
+        self.assertTrue('not a result' in err)
+        results = [self.receiver.results.get(timeout=5)[:4] for i in range(2)]
+        self.assertEqual(results, [('web1', 'http', 0, 'fine'),
+                                   ('web1', '', 0, 'PING OK')])
+        # both results went over one connection
+        self.assertEqual(self.receiver.stats()['connections'], 1)
+
+    def test_session_lifetime_and_delimiter(self):
+        status, out, err = self.run_main(
+                ['--password', 'sekrit', '-d', ';', '--session-lifetime', '0'],
+                'web1;http;0;a\nweb1;http;0;b\n')
+        self.assertEqual(status, 0)
+        results = [self.receiver.results.get(timeout=5)[3] for i in range(2)]
+        self.assertEqual(results, ['a', 'b'])
+        self.assertEqual(self.receiver.stats()['connections'], 2)
+
+    def test_return_code_out_of_range(self):
+        status, out, err = self.run_main(['--password', 'sekrit'],
+                'web1\thttp\t0\ta\n'
+                'web1\thttp\t99999\tb\n'
+                'web1\t-1\tc\n'
+                'web1\thttp\t2\td\n')
+        self.assertEqual(status, 0)
+        self.assertEqual(out, '2 data packet(s) sent to host successfully.\n')
+        self.assertEqual(err.count('Skipping invalid input'), 2)
+        results = [self.receiver.results.get(timeout=5)[3] for i in range(2)]
+        self.assertEqual(results, ['a', 'd'])
+
+    def test_connection_refused(self):
+        self.receiver.stop()
+        status, out, err = self.run_main(['--password', 'sekrit'],
+                'web1\thttp\t0\tfine\n')
+        self.assertEqual(status, 2)
+        self.assertTrue(err.startswith('Error: could not send'))
+        self.assertEqual(out, '0 data packet(s) sent to host successfully.\n')
+
 class TestPacketMethods(unittest.TestCase):
 
     def setUp(self):
@@ -173,8 +1236,8 @@ class TestPacketMethods(unittest.TestCase):
         """)
 
         got_iv, got_timestamp = self.notif._decode_from_server(fromserver)
-        got_iv = [ ord(b) for b in got_iv ]
-        exp_iv = [ ord(b) for b in exp_iv ]
+        got_iv = list(bytearray(got_iv))
+        exp_iv = list(bytearray(exp_iv))
 
         self.assertEqual((got_iv, got_timestamp), (exp_iv, 0x4db9b0b1))
 
@@ -204,9 +1267,7 @@ class TestPacketMethods(unittest.TestCase):
 
         pkt = self.notif._encode_to_server(iv, timestamp, 0,
                 'linux-ix-slave10.build', 'buildbot-start', 'hello!')
-        self.assertEqual(
-                [ ord(b) for b in exp_pkt ],
-                [ ord(b) for b in pkt ])
+        self.assertEqual(list(bytearray(exp_pkt)), list(bytearray(pkt)))
 
     def test_encode_host_to_server(self):
         iv = base64.b64decode("""
@@ -233,13 +1294,9 @@ class TestPacketMethods(unittest.TestCase):
 
         pkt = self.notif._encode_to_server(iv, timestamp, 0,
                 'linux-ix-slave10.build', '', 'hello!')
-        self.assertEqual(
-                [ ord(b) for b in exp_pkt ],
-                [ ord(b) for b in pkt ])
+        self.assertEqual(list(bytearray(exp_pkt)), list(bytearray(pkt)))
 
     def test_encode_service_to_server_aes256(self):
-        if not mcrypt:
-            raise unittest.SkipTest("python-mcrypt not installed")
         iv = base64.b64decode("""
         7ensPMny90d3fCFfruLNODYz6lm855IZDAku6g4Id/zyZDi7VjADzawkLVoH+pM+LX6X6
         WUqA3EzMVxCOtQ+LDh26I6n61xUEImvGINCV7HB75smGZ+YTdD1jwrJzjcBRSCQ7AzsQB
@@ -265,9 +1322,7 @@ class TestPacketMethods(unittest.TestCase):
         pkt = self.notif._encode_to_server(iv, timestamp, 0,
                 'linux-ix-slave10.build', 'buildbot-start', 'hello!',
                 16, '1234')
-        self.assertEqual(
-                [ ord(b) for b in exp_pkt ],
-                [ ord(b) for b in pkt ])
+        self.assertEqual(list(bytearray(exp_pkt)), list(bytearray(pkt)))
 
     def test_encode_service_to_server_supports_unicode_strings(self):
         iv = base64.b64decode("""
@@ -299,24 +1354,77 @@ class TestPacketMethods(unittest.TestCase):
                                            u'linux-ix-slave10.build',
                                            u'buildbot-start',
                                            u'teste: éçãê')
-        self.assertEqual(
-            [ord(b) for b in exp_pkt],
-            [ord(b) for b in pkt])
+        self.assertEqual(list(bytearray(exp_pkt)), list(bytearray(pkt)))
+
+    def test_xor_short_packet(self):
+        # keys are cycled over packets of any length
+        pkt = self.notif._encrypt_packet(b'\x00\x01\x02\x03\x04', b'ab', 1,
+                                         'xyz')
+        self.assertEqual(pkt, bytes(bytearray([p ^ i ^ k
+                for p, i, k in zip(bytearray(b'\x00\x01\x02\x03\x04'),
+                                   bytearray(b'ababa'),
+                                   bytearray(b'xyzxy'))])))
+
+    def test_pack_to_server_reuses_templates(self):
+        def expected(return_code, plugin_output):
+            toserver = [3, 0, 1304029911, return_code, b'web1', b'http',
+                        plugin_output.encode('ascii')]
+            pkt = bytearray(struct.pack(self.notif.toserver_fmt, *toserver))
+            struct.pack_into('!L', pkt, 4, binascii.crc32(pkt) & 0xffffffff)
+            return bytes(pkt)
+
+        for return_code, plugin_output in [(2, 'x' * 600), (0, 'ok')]:
+            self.assertEqual(
+                self.notif._pack_to_server(1304029911, return_code, 'web1',
+                                           'http', plugin_output),
+                expected(return_code, plugin_output[:514]))
+        self.assertEqual(list(self.notif._templates), [('web1', 'http')])
+
+    def test_cipher_stream_continues_across_packets(self):
+        if not pynsca.DES:
+            raise unittest.SkipTest("PyCrypto not installed")
+        iv = bytes(bytearray(range(128)))
+        password = b'abcdefghijklmnopqrstuvwx'
+        first = self.notif._pack_to_server(1, 0, 'web1', 'http', 'one')
+        second = self.notif._pack_to_server(1, 2, 'web1', 'http', 'two')
+        for mode in (2, 3, 4, 8):
+            cipher, key_size = self.notif.crypto_modes[mode]
+            encrypt = self.notif._encryptor(iv, mode, password)
+            key = (password + b'\0' * key_size)[:key_size]
+            stream = cipher.new(key, cipher.MODE_CFB,
+                                iv[:cipher.block_size])
+            self.assertEqual(encrypt(first) + encrypt(second),
+                             stream.encrypt(first + second))
+        self.assertEqual(len(self.notif._cipher_contexts), 4)
+
+    def test_rijndael256_stream_continues_across_packets(self):
+        iv = bytes(bytearray(range(32)))
+        engine = pynsca._Rijndael256(b'k' * 32)
+        encrypt = engine.cfb8(iv)
+        self.assertEqual(encrypt(b'first packet') + encrypt(b'second'),
+                         engine.cfb8(iv)(b'first packetsecond'))
+
+    def test_missing_cipher_library(self):
+        self.notif.crypto_modes = {2: (None, 8)}
+        self.assertRaises(ImportError, self.notif._encryptor, 'iv', 2, 'pw')
 
     def test_force_str_converts_unicode_strings(self):
         result = self.notif._force_str(u'açafrão')
 
-        self.assertEqual(str, type(result))
+        self.assertEqual(bytes, type(result))
 
     def test_force_str_keeps_str_strings_untouched(self):
-        result = self.notif._force_str('hello')
+        result = self.notif._force_str(b'hello')
 
-        self.assertEqual(str, type(result))
+        self.assertEqual(bytes, type(result))
 
     def test_escape_newlines(self):
         self.assertEqual(
                 self.notif._escape_newlines('abc\a\t\n\\'),
                 'abc\a\t\\n\\\\')
+        self.assertEqual(
+                self.notif._escape_newlines(b'abc\a\t\n\\'),
+                b'abc\a\t\\n\\\\')
 
 
 
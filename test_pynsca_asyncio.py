@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+#coding: utf-8
+
+# The contents of this file are subject to the Mozilla Public License
+# Version 1.1 (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS"
+# basis, WITHOUT WARRANTY OF ANY KIND, either express or implied. See the
+# License for the specific language governing rights and limitations
+# under the License.
+#
+# The Original Code is pynsca.
+#
+# The Initial Developer of the Original Code is Dustin J. Mitchell.  Portions
+# created by Dustin J. Mitchell are Copyright (C) Mozilla, Inc. All Rights
+# Reserved.
+#
+# Alternatively, the contents of this file may be used under the terms of the
+# GNU Public License, Version 2 (the  "GPLv2 License"), in which case the
+# provisions of GPLv2 License are applicable instead of those above. If you
+# wish to allow use of your version of this file only under the terms of the
+# GPLv2 License and not to allow others to use your version of this file under
+# the MPL, indicate your decision by deleting the provisions above and replace
+# them with the notice and other provisions required by the GPLv2 License. If
+# you do not delete the provisions above, a recipient may use your version of
+# this file under either the MPL or the GPLv2 License.
+
+import gc
+import threading
+import socket
+import unittest
+import warnings
+import base64
+import pynsca
+try:
+    import asyncio
+    import pynsca_asyncio
+except (ImportError, SyntaxError):
+    pynsca_asyncio = None
+
+BANNER = base64.b64decode("""
+    unvxWHaOSEOA67AxsyjFCCOJ5i2d8pz5uHVA7A2ilccehh+UFWfXlVOIxwawjQ/UFvYBs
+    +mdraET7o4gkCTnrqoHQsBvGlbDoh7KU6vZJ8HQKHW5xiJb2RDq+aAO4U+56ZJ5WKzQHE
+    /u5qKZwMpbkPPQSrnzpZMDj42knW7zVlhNubCx
+""")
+
+class TestAsyncNSCANotifier(unittest.TestCase):
+
+    def setUp(self):
+        if not pynsca_asyncio:
+            raise unittest.SkipTest("asyncio not available")
+        self.banner = BANNER
+        self.received = []
+        self.lock = threading.Lock()
+        self.accepted = 0
+        self.release = threading.Event()
+        self.release.set()
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(50)
+        self.port = self.sock.getsockname()[1]
+
+        self.server_thread = threading.Thread(target=self.server)
+        self.server_thread.daemon = True
+        self.server_thread.start()
+
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+        self.sock.close()
+
+    def server(self):
+        while 1:
+            try:
+                sock, addr = self.sock.accept()
+            except socket.error:
+                return
+            thd = threading.Thread(target=self.handle, args=(sock,))
+            thd.daemon = True
+            thd.start()
+
+    def handle(self, sock):
+        with self.lock:
+            self.accepted += 1
+        self.release.wait()
+        if self.banner:
+            sock.sendall(self.banner)
+        buf = b''
+        while 1:
+            data = sock.recv(1024)
+            if not data:
+                break
+            buf += data
+        sock.close()
+        with self.lock:
+            self.received.append(buf)
+
+    def complete(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def wait_for_connections(self, n):
+        for i in range(500):
+            with self.lock:
+                if len(self.received) >= n:
+                    return
+            self.loop.run_until_complete(asyncio.sleep(0.01))
+
+    def encode(self, return_code, host_name, svc_description, plugin_output):
+        n = pynsca.NSCANotifier('')
+        iv, timestamp = n._decode_from_server(BANNER)
+        return n._encode_to_server(iv, timestamp, return_code, host_name,
+                                   svc_description, plugin_output)
+
+    def test_svc_result(self):
+        notif = pynsca_asyncio.AsyncNSCANotifier('127.0.0.1', self.port)
+        self.complete(notif.svc_result('web1', 'http', pynsca.OK, 'fine'))
+        self.wait_for_connections(1)
+        self.assertEqual(self.received, [self.encode(0, 'web1', 'http', 'fine')])
+
+    def test_svc_results_one_connection(self):
+        notif = pynsca_asyncio.AsyncNSCANotifier('127.0.0.1', self.port)
+        sent = self.complete(notif.svc_results([
+            ('web1', 'http', pynsca.OK, 'fine'),
+            ('web1', '', pynsca.UP, 'PING OK'),
+        ]))
+        self.assertEqual(sent, 2)
+        self.wait_for_connections(1)
+        self.assertEqual(self.received, [
+            self.encode(0, 'web1', 'http', 'fine') +
+            self.encode(0, 'web1', '', 'PING OK')])
+
+    def test_submit_all_limits_concurrency(self):
+        notif = pynsca_asyncio.AsyncNSCANotifier('127.0.0.1', self.port,
+                                                 concurrency=2)
+        results = [('web%d' % i, 'http', pynsca.OK, 'fine') for i in range(6)]
+        self.release.clear()
+        task = self.loop.create_task(notif.submit_all(results))
+        self.complete(asyncio.sleep(0.2))
+        self.assertEqual(self.accepted, 2)
+
+        self.release.set()
+        self.assertEqual(self.complete(task), [None] * 6)
+        self.wait_for_connections(6)
+        self.assertEqual(sorted(self.received),
+                         sorted([self.encode(r[2], r[0], r[1], r[3])
+                                 for r in results]))
+
+    def test_deadline(self):
+        self.banner = None
+        notif = pynsca_asyncio.AsyncNSCANotifier('127.0.0.1', self.port)
+        try:
+            self.complete(notif.svc_results([('web1', 'http', 0, 'fine')],
+                                       timeout=0.1))
+        except pynsca.NSCASendError as e:
+            self.assertEqual(e.sent, 0)
+            self.assertTrue(isinstance(e.error, asyncio.TimeoutError))
+        else:
+            self.fail("NSCASendError not raised")
+
+    def test_deadline_while_waiting_for_a_slot(self):
+        notif = pynsca_asyncio.AsyncNSCANotifier('127.0.0.1', self.port,
+                                                 concurrency=1)
+        self.release.clear()
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            errors = [type(e) for e in self.complete(notif.submit_all(
+                [('web1', 'http', 0, 'fine'), ('web2', 'http', 0, 'fine')],
+                timeout=0.1))]
+            # an abandoned coroutine only warns once it is collected
+            gc.collect()
+        self.release.set()
+        self.assertEqual(errors, [asyncio.TimeoutError] * 2)
+        self.assertEqual([str(w.message) for w in caught], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+#coding: utf-8
+
+# The contents of this file are subject to the Mozilla Public License
+# Version 1.1 (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS"
+# basis, WITHOUT WARRANTY OF ANY KIND, either express or implied. See the
+# License for the specific language governing rights and limitations
+# under the License.
+#
+# The Original Code is pynsca.
+#
+# The Initial Developer of the Original Code is Dustin J. Mitchell.  Portions
+# created by Dustin J. Mitchell are Copyright (C) Mozilla, Inc. All Rights
+# Reserved.
+#
+# Alternatively, the contents of this file may be used under the terms of the
+# GNU Public License, Version 2 (the  "GPLv2 License"), in which case the
+# provisions of GPLv2 License are applicable instead of those above. If you
+# wish to allow use of your version of this file only under the terms of the
+# GPLv2 License and not to allow others to use your version of this file under
+# the MPL, indicate your decision by deleting the provisions above and replace
+# them with the notice and other provisions required by the GPLv2 License. If
+# you do not delete the provisions above, a recipient may use your version of
+# this file under either the MPL or the GPLv2 License.
+import unittest
+import pynsca
+from test_pynsca import start_receiver
+try:
+    import numpy
+    import pynsca_numpy
+except ImportError:
+    pynsca_numpy = None
+
+IV = bytes(bytearray(range(128)))
+
+class TestBatchEncoder(unittest.TestCase):
+
+    results = [
+        ('web1', 'http', pynsca.OK, 'fine'),
+        ('web2', 'http', pynsca.CRITICAL, 'down\nreally \\ down'),
+        (u'web3', u'', pynsca.UP, u'teste: éçãê' * 100),
+    ]
+
+    def setUp(self):
+        if not pynsca_numpy:
+            raise unittest.SkipTest("NumPy not installed")
+
+    def columns(self):
+        return [list(column) for column in zip(*self.results)]
+
+    def expected(self, notif, encrypt):
+        return b''.join([encrypt(notif._pack_to_server(1304029911, rc, host,
+                                                       svc, output))
+                         for host, svc, rc, output in self.results])
+
+    def test_dtype_matches_toserver_fmt(self):
+        self.assertEqual(pynsca_numpy.BatchEncoder.toserver_dtype.itemsize,
+                         pynsca.NSCANotifier.toserver_fmt_size)
+
+    def test_encode(self):
+        notif = pynsca.NSCANotifier('127.0.0.1')
+        hosts, svcs, rcs, outputs = self.columns()
+        packets = pynsca_numpy.BatchEncoder(notif).encode(1304029911, hosts,
+                svcs, rcs, outputs)
+        self.assertEqual(packets.shape, (3, 720))
+        self.assertEqual(packets.tobytes(),
+                         self.expected(notif, lambda pkt: pkt))
+
+    def test_encrypt(self):
+        for mode, password in [(0, None), (1, None), (1, 'ham'), (16, '1234')]:
+            notif = pynsca.NSCANotifier('127.0.0.1', encryption_mode=mode,
+                                        password=password)
+            encoder = pynsca_numpy.BatchEncoder(notif)
+            packets = encoder.encode(1304029911, *self.columns())
+            encrypt = notif._encryptor(IV, mode, password)
+            self.assertEqual(encoder.encrypt(packets, IV).tobytes(),
+                             self.expected(notif, encrypt))
+
+    def test_send(self):
+        receiver = start_receiver(self, password='ham')
+        notif = pynsca.NSCANotifier('127.0.0.1', receiver.port,
+                                    password='ham')
+        hosts = numpy.array(['web%d' % i for i in range(100)])
+        sent = pynsca_numpy.BatchEncoder(notif).send(hosts, 'http',
+                numpy.zeros(100, int), 'fine')
+        self.assertEqual(sent, 100)
+        self.assertEqual(
+            [receiver.results.get(timeout=5)[:4] for i in range(100)],
+            [('web%d' % i, 'http', 0, 'fine') for i in range(100)])
+        self.assertEqual(receiver.stats()['connections'], 1)
+
+    def test_send_takes_a_token_per_packet(self):
+        receiver = start_receiver(self)
+        rate = pynsca.RateController(rate=1000, burst=8)
+        notif = pynsca.NSCANotifier('127.0.0.1', receiver.port,
+                                    rate_controller=rate)
+        hosts = numpy.array(['web%d' % i for i in range(20)])
+        sent = pynsca_numpy.BatchEncoder(notif).send(hosts, 'http',
+                numpy.zeros(20, int), 'fine')
+        self.assertEqual(sent, 20)
+        self.assertEqual(
+            [receiver.results.get(timeout=5)[0] for i in range(20)],
+            ['web%d' % i for i in range(20)])
+        # one token for the connection, one per packet
+        self.assertEqual(rate.stats()['acquired'], 21)
+
+
+if __name__ == '__main__':
+    unittest.main()